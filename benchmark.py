@@ -0,0 +1,392 @@
+import argparse
+import gc
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import instrument
+from cfg import ContextFreeGrammar
+from regex_to_NFA import NFAfromRegex, RegexSet
+
+# Regexes with many simultaneously active NFA states
+REGEXES = [
+    ("(a|b)*abb", "ab"),
+    ("(a|b)*a(a|b)(a|b)(a|b)(a|b)", "ab"),
+    ("((ab|ba)*|(a|c)+b)*(a|b|c)*", "abc"),
+]
+
+# Generate reproducible input strings over a small alphabet
+def generate_strings(count, length, alphabet="abc", seed=0):
+    rng = random.Random(seed)
+    return ["".join(rng.choice(alphabet) for _ in range(length)) for _ in range(count)]
+
+# Return the best wall time of a few runs of matcher over all strings
+def time_matcher(matcher, strings, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for string in strings:
+            matcher(string)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+# Compare the set based NFA loop with the bitset simulation
+def bench_bitset(count=200, length=200):
+    print(f"{'regex':40} {'set (s)':>10} {'bitset (s)':>10} {'speedup':>8}")
+    for regex, alphabet in REGEXES:
+        strings = generate_strings(count, length, alphabet)
+        nfa = NFAfromRegex(regex).getNFA()
+        for string in strings:
+            if nfa.test_string(string) != nfa.test_string_bitset(string):
+                raise AssertionError(f"bitset result differs for {regex!r}")
+        set_time = time_matcher(nfa.test_string, strings)
+        bitset_time = time_matcher(nfa.test_string_bitset, strings)
+        print(f"{regex:40} {set_time:10.4f} {bitset_time:10.4f} {set_time / bitset_time:7.1f}x")
+
+# Generate reproducible keyword-like patterns such as "ab(c|d)*e"
+def generate_patterns(count, alphabet="abcdef", seed=0):
+    rng = random.Random(seed)
+    patterns = []
+    for _ in range(count):
+        prefix = "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 3)))
+        loop = "|".join(rng.sample(alphabet, 2))
+        suffix = "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 3)))
+        patterns.append(f"{prefix}({loop})*{suffix}")
+    return patterns
+
+# Compare one RegexSet pass per input with one test_string call per rule
+def bench_regexset(counts=(10, 100, 1000, 10000), inputs=500, length=8):
+    strings = generate_strings(inputs, length, "abcdef")
+    print(f"{'patterns':>8} {'build (s)':>10} {'set us/input':>13} {'per rule us/input':>18}")
+    for count in counts:
+        patterns = generate_patterns(count)
+        start = time.perf_counter()
+        regexset = RegexSet(patterns)
+        build_time = time.perf_counter() - start
+        # The first pass discovers the lazy DFA states, later passes reuse them
+        time_matcher(regexset.match, strings, repeat=1)
+        set_time = time_matcher(regexset.match, strings) / len(strings)
+        nfas = [NFAfromRegex(pattern).getNFA() for pattern in patterns]
+        sample = strings[:max(1, inputs * 10 // count)]
+        def per_rule(string):
+            return [i for i, nfa in enumerate(nfas) if nfa.test_string(string)]
+        for string in sample[:20]:
+            if list(regexset.match(string)) != per_rule(string):
+                raise AssertionError(f"RegexSet result differs on {string!r}")
+        rule_time = time_matcher(per_rule, sample, repeat=1) / len(sample)
+        print(f"{count:8} {build_time:10.3f} {set_time * 1e6:13.1f} {rule_time * 1e6:18.1f}")
+
+# Generate a reproducible regex of at least size characters by concatenating
+# words, alternations, stars and positive closures
+def generate_regex(size, alphabet="abcdef", seed=0):
+    rng = random.Random(seed)
+    parts = []
+    length = 0
+    while length < size:
+        words = ["".join(rng.choice(alphabet) for _ in range(rng.randint(1, 4))) for _ in range(3)]
+        kind = rng.randrange(4)
+        if kind == 0:
+            part = words[0]
+        elif kind == 1:
+            part = "(" + "|".join(words) + ")"
+        elif kind == 2:
+            part = "(" + words[0] + ")*"
+        else:
+            part = "(" + words[0] + "|" + words[1] + ")+"
+        parts.append(part)
+        length += len(part)
+    return "".join(parts)
+
+# Generate a reproducible grammar with about nrules rules
+# Variables are fixed width names (V000, V001, ...) so none contains another,
+# every variable has a terminal rule so all of them are productive, and a few
+# variables get null rules
+def generate_grammar(nrules, terminals="abcd", seed=0):
+    rng = random.Random(seed)
+    nvariables = max(2, nrules // 5)
+    width = len(str(nvariables - 1))
+    variables = ["V" + str(i).zfill(width) for i in range(nvariables)]
+    symbols = variables + list(terminals)
+    rules = {variable: {rng.choice(terminals)} for variable in variables}
+    for variable in rng.sample(variables, max(1, nvariables // 10)):
+        rules[variable].add("λ")
+    count = sum(len(bodies) for bodies in rules.values())
+    while count < nrules:
+        variable = rng.choice(variables)
+        body = "".join(rng.choice(symbols) for _ in range(rng.randint(2, 4)))
+        if body not in rules[variable]:
+            rules[variable].add(body)
+            count += 1
+    return ContextFreeGrammar(set(variables), set(terminals) | {"λ"}, rules, variables[0], "λ")
+
+# Arithmetic expression grammar, LR(1) and left recursive
+def expression_grammar():
+    return ContextFreeGrammar({"E", "T", "F"}, {"+", "*", "(", ")", "a", "λ"},
+                              {"E": ["E+T", "T"], "T": ["T*F", "F"], "F": ["(E)", "a"]}, "E", "λ")
+
+# Generate a reproducible expression of the expression grammar with at least size characters
+def generate_expression(size, seed=0):
+    rng = random.Random(seed)
+    out = []
+    def term(depth):
+        choice = rng.random()
+        if depth > 8 or choice < 0.3:
+            out.append("a")
+        elif choice < 0.45:
+            out.append("(")
+            term(depth + 1)
+            out.append(")")
+        else:
+            term(depth + 1)
+            out.append(rng.choice("+*"))
+            term(depth + 1)
+    while len(out) < size:
+        if out:
+            out.append("+")
+        term(0)
+    return "".join(out)
+
+# Compare CYK on the compiled CNF grammar with Earley on the rules as they are
+def bench_earley(lengths=(50, 100, 200, 400)):
+    grammar = expression_grammar()
+    grammar.compile()
+    grammar.earley_parser()
+    print(f"{'length':>8} {'cyk (s)':>10} {'earley (s)':>10} {'speedup':>8}")
+    for length in lengths:
+        text = generate_expression(length)
+        if grammar.cyk_algorithm(text) != grammar.earley_algorithm(text):
+            raise AssertionError(f"Earley result differs on {text!r}")
+        cyk_time = time_matcher(grammar.cyk_algorithm, [text], repeat=1)
+        earley_time = time_matcher(grammar.earley_algorithm, [text])
+        print(f"{len(text):8} {cyk_time:10.4f} {earley_time:10.4f} {cyk_time / earley_time:7.1f}x")
+
+# Workloads shared by several cases and repeats, keyed by what they are built from
+workloads = {}
+
+# Return a shared workload, building it the first time a selected case needs it
+def workload(key, build):
+    if key not in workloads:
+        workloads[key] = build()
+    return workloads[key]
+
+def regex_nfa(regex):
+    return workload(("nfa", regex), lambda: NFAfromRegex(regex).getNFA())
+
+def random_text(size, alphabet):
+    return workload(("text", size, alphabet), lambda: generate_strings(1, size, alphabet)[0])
+
+# Return the matcher of one engine for a regex
+def engine_matcher(engine, regex):
+    nfa = regex_nfa(regex)
+    if engine == "set":
+        return nfa.test_string
+    if engine == "frozen":
+        return workload(("frozen", regex), nfa.freeze).test_string
+    if engine == "bitset":
+        return nfa.test_string_bitset
+    return workload(("dfa", regex), nfa.to_dfa).test_string
+
+# Return a grammar with its CYK recognizer and Earley tables built
+def prepared_grammar(nrules=None):
+    def build():
+        grammar = expression_grammar() if nrules is None else generate_grammar(nrules)
+        grammar.compile()
+        grammar.earley_parser()
+        return grammar
+    return workload(("grammar", nrules), build)
+
+# Return the benchmark cases as (name, setup) pairs
+# setup prepares a workload outside the timed region and returns the
+# function to time, so every repeat starts from the same state
+# Workloads are only built by setup, so cases left out by a filter cost nothing
+def build_cases(quick=False):
+    cases = []
+
+    regex_sizes = (10, 100, 1000) if quick else (10, 100, 1000, 10000)
+    for size in regex_sizes:
+        def build(size=size):
+            regex = generate_regex(size)
+            return lambda: NFAfromRegex(regex)
+        def freeze(size=size):
+            return regex_nfa(generate_regex(size)).freeze
+        cases.append((f"regex/build/{size}", build))
+        cases.append((f"regex/freeze/{size}", freeze))
+
+    input_sizes = (1000, 10000) if quick else (1000, 100000, 1000000)
+    for regex, alphabet in REGEXES[:2]:
+        for size in input_sizes:
+            for engine in ("set", "frozen", "bitset", "dfa"):
+                def match(engine=engine, regex=regex, size=size, alphabet=alphabet):
+                    matcher = engine_matcher(engine, regex)
+                    text = random_text(size, alphabet)
+                    return lambda: matcher(text)
+                cases.append((f"match/{engine}/{regex}/{size}", match))
+            def search(regex=regex, size=size, alphabet=alphabet):
+                nfa = regex_nfa(regex)
+                text = random_text(size, alphabet)
+                return lambda: list(nfa.finditer(text))
+            cases.append((f"search/{regex}/{size}", search))
+
+    pattern_counts = (10, 100) if quick else (10, 100, 1000, 10000)
+    for count in pattern_counts:
+        def build(count=count):
+            patterns = generate_patterns(count)
+            return lambda: RegexSet(patterns)
+        def match(count=count):
+            regexset = workload(("regexset", count), lambda: RegexSet(generate_patterns(count)))
+            strings = workload(("strings", 500, 8), lambda: generate_strings(500, 8, "abcdef"))
+            return lambda: [regexset.match(s) for s in strings]
+        cases.append((f"regexset/build/{count}", build))
+        cases.append((f"regexset/match/{count}", match))
+
+    rule_counts = (10, 100) if quick else (10, 100, 1000)
+    for nrules in rule_counts:
+        cases.append((f"cfg/cnf/{nrules}",
+                      lambda nrules=nrules: generate_grammar(nrules).convert_to_cnf))
+        cases.append((f"cfg/compile/{nrules}",
+                      lambda nrules=nrules: generate_grammar(nrules).compile))
+
+    # The grammar is compiled once, every check reuses the recognizer
+    # Earley runs on the same grammars and inputs as CYK, its tables are also built once
+    # None stands for the expression grammar
+    cyk_cases = ((10, 8), (100, 8)) if quick else ((10, 16), (100, 16), (100, 32))
+    expr_lengths = (50, 100) if quick else (50, 100, 200)
+    long_lengths = (1000,) if quick else (1000, 10000)
+    grammar_cases = ([(algorithm, nrules, length) for nrules, length in cyk_cases
+                      for algorithm in ("cyk", "earley")] +
+                     [(algorithm, None, length) for length in expr_lengths
+                      for algorithm in ("cyk", "earley")] +
+                     [(algorithm, None, length) for length in long_lengths
+                      for algorithm in ("earley", "parse")])
+    for algorithm, nrules, length in grammar_cases:
+        def check(algorithm=algorithm, nrules=nrules, length=length):
+            grammar = prepared_grammar(nrules)
+            if nrules is None:
+                text = generate_expression(length)
+            else:
+                text = generate_strings(1, length, "abcd")[0]
+            if algorithm == "cyk":
+                return lambda: grammar.cyk_algorithm(text)
+            if algorithm == "earley":
+                return lambda: grammar.earley_algorithm(text)
+            return lambda: grammar.parse_forest(text)
+        cases.append((f"cfg/{algorithm}/{'expr' if nrules is None else nrules}/{length}", check))
+
+    return cases
+
+# Time one case and measure its memory use
+# Returns the best and median wall time of the repeats, the peak traced
+# memory, and the number of memory blocks allocated by the run that are
+# still alive when it returns, including its result
+# tracemalloc forgets freed blocks, so blocks allocated and freed during the
+# run are not counted; they show in the peak memory instead
+def measure(setup, repeat):
+    times = []
+    for _ in range(repeat):
+        function = setup()
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    times.sort()
+
+    # Memory is measured on a separate run, tracing slows the code down
+    function = setup()
+    gc.collect()
+    tracemalloc.start()
+    result = function()
+    peak = tracemalloc.get_traced_memory()[1]
+    live_blocks = len(tracemalloc.take_snapshot().traces)
+    tracemalloc.stop()
+    del result
+    return {"best": times[0], "median": times[len(times) // 2], "repeat": repeat,
+            "peak_bytes": peak, "live_blocks": live_blocks}
+
+# Run a case once more with instrumentation on and return what it recorded
+def record(setup):
+    function = setup()
+    with instrument.recording():
+        function()
+    return instrument.report()
+
+# Run every case whose name contains one of the filters
+# With instrumented set, each result also gets the instrumentation report
+def run_cases(cases, repeat, filters=None, instrumented=False):
+    results = {}
+    print(f"{'benchmark':58} {'best (s)':>10} {'median (s)':>10} {'peak KiB':>10} {'live blocks':>11}")
+    for name, setup in cases:
+        if filters and not any(f in name for f in filters):
+            continue
+        result = measure(setup, repeat)
+        if instrumented:
+            result["instrumentation"] = record(setup)
+        results[name] = result
+        print(f"{name:58} {result['best']:10.5f} {result['median']:10.5f} "
+              f"{result['peak_bytes'] / 1024:10.1f} {result['live_blocks']:11}")
+    return results
+
+# Compare best times with a previous run
+# Returns the names of the benchmarks slower than baseline by more than threshold
+def compare(results, baseline, threshold):
+    regressions = []
+    print(f"\n{'benchmark':58} {'baseline (s)':>12} {'now (s)':>10} {'change':>8}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]["best"]
+        change = result["best"] / before - 1 if before > 0 else 0.0
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:58} {before:12.5f} {result['best']:10.5f} {change:+8.1%}{flag}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the regex engine and the CFG algorithms.")
+    parser.add_argument("--quick", action="store_true", help="use smaller workloads")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per benchmark")
+    parser.add_argument("-k", "--filter", action="append",
+                        help="only run benchmarks whose name contains this text, can be repeated")
+    parser.add_argument("-o", "--output", help="save the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="relative slowdown of the best time counted as a regression")
+    parser.add_argument("--instrument", action="store_true",
+                        help="add the instrumentation counters of one more run to every result")
+    parser.add_argument("--reports", action="store_true",
+                        help="print the bitset, RegexSet and Earley comparison reports instead")
+    args = parser.parse_args(argv)
+
+    if args.reports:
+        bench_bitset()
+        print()
+        bench_regexset()
+        print()
+        bench_earley()
+        return 0
+
+    results = run_cases(build_cases(args.quick), args.repeat, args.filter, args.instrument)
+
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump({"python": platform.python_version(), "platform": platform.platform(),
+                       "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "quick": args.quick,
+                       "results": results}, outfile, indent=2)
+
+    if args.compare:
+        with open(args.compare) as infile:
+            baseline = json.load(infile)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} benchmark(s) regressed by more than {args.threshold:.0%}")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
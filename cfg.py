@@ -1,6 +1,9 @@
 
-import re
-from copy import deepcopy, copy
+import time
+from copy import copy
+from itertools import product
+
+import instrument
 
 def contain_each_other(str1, str2):
     count_str1_in_str2 = str2.count(str1)
@@ -18,22 +21,537 @@ def has_space(s):
             return True
     return False
 
-def escape_re(iterable):
-    for item in iterable:
-        yield re.escape(item)
+def split_symbols(string, symbol_table):
+    """
+    Splits a string into the symbols of symbol_table, a dictionary from first characters to the
+    symbols starting with them. Returns None if the string cannot be split.
+    """
+    symbols = []
+    i = 0
+    while i < len(string):
+        for symbol in symbol_table.get(string[i], ()):
+            if string.startswith(symbol, i):
+                symbols.append(symbol)
+                i += len(symbol)
+                break
+        else:
+            return None
+    return symbols
+
+class CYKRecognizer:
+    """
+    Immutable, hashable membership test for a grammar, compiled by ContextFreeGrammar.compile().
+    Variables are numbered by integer ids and sets of variables are int bitmasks. Input strings
+    are split into terminal ids, so terminals may be longer than one character.
+    """
+    __slots__ = ('_start', '_accepts_null', '_null_character', '_terminal', '_terminal_ids',
+                 '_terminal_table', '_binary', '_follow', '_key')
+
+    def __init__(self, start, accepts_null, null_character, terminal, binary):
+        """
+        Takes the start variable id, whether the empty string is accepted, the null character, the
+        terminal rules as {a: A mask} and the binary rules as {B: {C: A mask}}.
+        """
+        key = (start, accepts_null, null_character, frozenset(terminal.items()),
+               frozenset((b, c, heads) for b, row in binary.items() for c, heads in row.items()))
+        object.__setattr__(self, '_start', start)
+        object.__setattr__(self, '_accepts_null', accepts_null)
+        object.__setattr__(self, '_null_character', null_character)
+        terminals = sorted(terminal)
+        terminal_table = {}
+        for symbol in terminals:
+            terminal_table.setdefault(symbol[0], []).append(symbol)
+        # The A mask of every terminal id, and the ids and split_symbols table of the terminals
+        object.__setattr__(self, '_terminal', tuple(terminal[symbol] for symbol in terminals))
+        object.__setattr__(self, '_terminal_ids', {symbol: i for i, symbol in enumerate(terminals)})
+        object.__setattr__(self, '_terminal_table', terminal_table)
+        object.__setattr__(self, '_binary', {b: dict(row) for b, row in binary.items()})
+        # For every B, the mask of the variables C that can follow it
+        object.__setattr__(self, '_follow', {b: sum(1 << c for c in row) for b, row in binary.items()})
+        object.__setattr__(self, '_key', key)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CYKRecognizer is immutable.")
+
+    def __delattr__(self, name):
+        raise AttributeError("CYKRecognizer is immutable.")
+
+    def __eq__(self, other):
+        return isinstance(other, CYKRecognizer) and self._key == other._key
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __contains__(self, string):
+        return self.accepts(string)
+
+    def accepts(self, string):
+        """
+        Checks if the grammar can generate the passed string using the CYK algorithm on a flat
+        triangular table of bitmasks.
+        """
+        if string == '':
+            return self._accepts_null
+
+        if string == self._null_character:
+            return False
+
+        symbols = split_symbols(string, self._terminal_table)
+        if symbols is None:
+            return False
+        terminal_ids = self._terminal_ids
+        tokens = [terminal_ids[symbol] for symbol in symbols]
+
+        n = len(tokens)
+        binary = self._binary
+        follow = self._follow
+
+        # The cells live in one flat triangular list, row by span length: the cell of the
+        # substring of length l starting at i is table[offsets[l] + i]
+        offsets = [0, 0]
+        for length in range(1, n):
+            offsets.append(offsets[-1] + n - length + 1)
+        terminal = self._terminal
+        table = [terminal[token] for token in tokens]
+        table.extend(0 for _ in range(offsets[n] + 1 - n))
+
+        # The same masks come back in many cells, so their variable ids are decomposed once
+        decomposed = {}
+
+        def members(mask):
+            """
+            Returns the ids of the variables in mask.
+            """
+            found = decomposed.get(mask)
+            if found is None:
+                found = []
+                rest = mask
+                while rest:
+                    low = rest & -rest
+                    rest ^= low
+                    found.append(low.bit_length() - 1)
+                decomposed[mask] = found
+            return found
+
+        for length in range(2, n + 1):
+            for i in range(n - length + 1):
+                cell = 0
+                for split in range(1, length):
+                    left = table[offsets[split] + i]
+                    if not left:
+                        continue
+                    right = table[offsets[length - split] + i + split]
+                    if not right:
+                        continue
+                    for b in members(left):
+                        matches = follow.get(b, 0) & right
+                        if matches:
+                            row = binary[b]
+                            for c in members(matches):
+                                cell |= row[c]
+                table[offsets[length] + i] = cell
+
+        if instrument.enabled:
+            # Every split point with two non-empty child cells looks up the binary
+            # rules of each variable of its left cell once
+            instrument.count("ContextFreeGrammar.cyk_algorithm.calls")
+            instrument.count("ContextFreeGrammar.cyk_algorithm.cells", len(table))
+            instrument.count("ContextFreeGrammar.cyk_algorithm.nonempty_cells", sum(1 for cell in table if cell))
+            instrument.count("ContextFreeGrammar.cyk_algorithm.rule_scans",
+                             sum(bin(table[offsets[split] + i]).count("1")
+                                 for length in range(2, n + 1) for i in range(n - length + 1)
+                                 for split in range(1, length)
+                                 if table[offsets[length - split] + i + split]))
+
+        return self._start is not None and table[offsets[n]] >> self._start & 1 == 1
+
+# Tasks of SPPFNode.trees
+_TREE, _SEQUENCE, _WRAP, _APPEND = range(4)
+
+class SPPFNode:
+    """
+    Node of a shared packed parse forest. A symbol node is labelled with a variable or terminal,
+    an intermediate node with (variable, rule symbols, dot) for the first dot symbols of a rule.
+    Both span the input tokens start to end. Every family is one way of deriving the node: a
+    tuple with the intermediate node of a rule for symbol nodes, or the intermediate node of the
+    shorter prefix (left out when empty) and the symbol node of the last symbol for intermediate
+    nodes. Terminal nodes have no families.
+    """
+    __slots__ = ('label', 'start', 'end', 'families')
+
+    def __init__(self, label, start, end):
+        self.label = label
+        self.start = start
+        self.end = end
+        self.families = []
+
+    def __repr__(self):
+        return 'SPPFNode({!r}, {}, {})'.format(self.label, self.start, self.end)
+
+    def is_ambiguous(self):
+        """
+        Checks if the input has more than one parse tree below this node.
+        """
+        seen = set()
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if id(node) in seen:
+                continue
+            seen.add(id(node))
+            if len(node.families) > 1:
+                return True
+            for family in node.families:
+                stack.extend(family)
+        return False
+
+    def trees(self):
+        """
+        Yields the parse trees of the forest as nested tuples (variable, children...), with
+        terminals as strings. Derivations that go through a node already being expanded are
+        skipped, so cyclic grammars yield their finite trees only.
+        """
+        # Depth first search over the family chosen at every node, without recursion. A branch
+        # is two linked lists of (head, tail) pairs: the tasks left and the finished subtrees and
+        # child sequences, so the branches of a choice share everything built before it. Tasks
+        # expand a node below a path of (node, path) ancestors, or combine finished values.
+        branches = [(((_TREE, self, None), None), None)]
+        while branches:
+            tasks, values = branches.pop()
+            while tasks is not None:
+                task, tasks = tasks
+                kind = task[0]
+                if kind == _WRAP:
+                    children, values = values
+                    values = ((task[1],) + children, values)
+                    continue
+                if kind == _APPEND:
+                    last, (children, values) = values
+                    values = (children + (last,), values)
+                    continue
+                node, path = task[1], task[2]
+                if (kind == _TREE and not node.families and not isinstance(node.label, tuple)
+                        and node.end == node.start + 1):
+                    values = (node.label, values)
+                    continue
+                # Children span part of their parent, so an ancestor that is the same node
+                # is among the nearest ones with the same span
+                ancestor = path
+                while (ancestor is not None and ancestor[0] is not node
+                       and ancestor[0].start == node.start and ancestor[0].end == node.end):
+                    ancestor = ancestor[1]
+                if ancestor is not None and ancestor[0] is node:
+                    break
+                path = (node, path)
+                options = []
+                for family in node.families:
+                    if kind == _TREE:
+                        options.append((((_SEQUENCE, family[0], path), ((_WRAP, node.label), tasks)), values))
+                    elif len(family) == 2:
+                        options.append((((_SEQUENCE, family[0], path),
+                                         ((_TREE, family[1], path), ((_APPEND,), tasks))), values))
+                    elif len(family) == 1:
+                        options.append((((_TREE, family[0], path), ((_APPEND,), tasks)), ((), values)))
+                    else:
+                        options.append((tasks, ((), values)))
+                if not options:
+                    break
+                branches.extend(reversed(options[1:]))
+                tasks, values = options[0]
+            else:
+                yield values[0]
 
-class RuleTreeNode:
-    def __init__(self, value=None):
-        self.value = value
+class EarleyParser:
+    """
+    Earley recognizer and parser working directly on a grammar's rules, without converting them
+    to CNF. Built by ContextFreeGrammar.earley_parser().
+    """
 
-    def children(self, pattern):
-        for i in range(len(self.value)):
-            if pattern.fullmatch(self.value[i][0]) and not self.value[i][1]:
-                first_value = deepcopy(self.value)
-                first_value[i][1] = True
-                second_value = deepcopy(self.value)
-                del second_value[i]
-                return RuleTreeNode(first_value), RuleTreeNode(second_value)
+    def __init__(self, grammar):
+        """
+        Splits the rules into integer symbol ids and precomputes the nullable variables and, for
+        every variable, the items its prediction adds.
+        """
+        variables = sorted(grammar.variables)
+        terminals = sorted(grammar.terminals - {grammar.null_character})
+        self.names = variables + terminals
+        self.variable_count = len(variables)
+        ids = {symbol: i for i, symbol in enumerate(self.names)}
+        self.terminal_table = {}
+        for terminal in terminals:
+            self.terminal_table.setdefault(terminal[0], []).append(terminal)
+        self.terminal_ids = {terminal: ids[terminal] for terminal in terminals}
+
+        # The grammar's interned ids are mapped to dense ids, variables first
+        dense = {grammar._intern(symbol): i for symbol, i in ids.items()}
+        null = grammar._intern(grammar.null_character)
+        names = grammar._symbol_names
+        self.heads = []
+        self.bodies = []
+        self.rules_of = [[] for _ in variables]
+        for var, body in sorted(grammar._tokenized()):
+            if var not in dense or dense[var] >= self.variable_count:
+                raise ValueError("Rule variable {} is not in the variables set.".format(names[var]))
+            self.rules_of[dense[var]].append(len(self.heads))
+            self.heads.append(dense[var])
+            self.bodies.append(tuple(dense[symbol] for symbol in body if symbol != null))
+        self.start = ids.get(grammar.start_variable)
+
+        nullable = [False] * len(self.names)
+        changed = True
+        while changed:
+            changed = False
+            for r, body in enumerate(self.bodies):
+                if not nullable[self.heads[r]] and all(nullable[symbol] for symbol in body):
+                    nullable[self.heads[r]] = changed = True
+        self.nullable = nullable
+
+        # Predicting A adds every rule of every variable that can start a derivation of A, with
+        # the dot at each position reachable by skipping nullable symbols (Aycock and Horspool)
+        self.predicted = []
+        self.predictions = []
+        for var in range(len(variables)):
+            predicted = [var]
+            found = {var}
+            items = []
+            for current in predicted:
+                for r in self.rules_of[current]:
+                    body = self.bodies[r]
+                    for dot in range(len(body) + 1):
+                        items.append((r, dot))
+                        if dot == len(body):
+                            break
+                        symbol = body[dot]
+                        if symbol < self.variable_count and symbol not in found:
+                            found.add(symbol)
+                            predicted.append(symbol)
+                        if not nullable[symbol]:
+                            break
+            self.predicted.append(frozenset(found))
+            self.predictions.append(tuple(items))
+
+    def tokenize(self, string):
+        """
+        Returns the terminal ids of string, or None if it is not a sequence of terminals.
+        """
+        symbols = split_symbols(string, self.terminal_table)
+        if symbols is None:
+            return None
+        return [self.terminal_ids[symbol] for symbol in symbols]
+
+    def chart(self, tokens):
+        """
+        Returns the Earley sets of the tokens, as sets of (rule, dot, origin) items, and the links
+        of Leo's deterministic reductions. When the only item of set j waiting on a variable A is
+        (B -> b.A, k), completing A from j also completes B from k, and so on up a chain. Only the
+        topmost item of the chain is added, so right recursion takes linear time and space. The
+        links map (j, A) to the (rule, origin) of the item the completion of A from j completes.
+        """
+        bodies = self.bodies
+        heads = self.heads
+        nullable = self.nullable
+        variable_count = self.variable_count
+        n = len(tokens)
+        sets = [set() for _ in range(n + 1)]
+        waiting = [{} for _ in range(n + 1)]
+        links = {}
+        # Topmost item of the chain of each (origin, variable), None when the completion is not
+        # deterministic. The start variable from 0 always stops a chain, so the item accepting
+        # the input is never left out.
+        tops = {(0, self.start): None}
+
+        def topmost(origin, var):
+            key = (origin, var)
+            chain = []
+            while key not in tops:
+                waiting_items = waiting[key[0]].get(key[1], ())
+                if len(waiting_items) != 1 or waiting_items[0][1] + 1 != len(bodies[waiting_items[0][0]]):
+                    tops[key] = None
+                    break
+                wr, wdot, worigin = waiting_items[0]
+                links[key] = (wr, worigin)
+                # Marked as not deterministic until the chain is resolved, which ends cycles
+                tops[key] = None
+                chain.append(key)
+                key = (worigin, heads[wr])
+            top = tops[key]
+            for key in reversed(chain):
+                if top is None:
+                    wr, worigin = links[key]
+                    top = (wr, len(bodies[wr]), worigin)
+                tops[key] = top
+            return tops[(origin, var)]
+        items = [(r, dot, 0) for r, dot in self.predictions[self.start]] if self.start is not None else []
+        for i in range(n + 1):
+            seen = sets[i]
+            waiting_here = waiting[i]
+            predicted = set()
+            scanned = []
+            token = tokens[i] if i < n else None
+            seen.update(items)
+            k = 0
+            while k < len(items):
+                item = items[k]
+                k += 1
+                r, dot, origin = item
+                body = bodies[r]
+                if dot < len(body):
+                    symbol = body[dot]
+                    if symbol >= variable_count:
+                        if symbol == token:
+                            scanned.append((r, dot + 1, origin))
+                        continue
+                    waiting_here.setdefault(symbol, []).append(item)
+                    if symbol not in predicted:
+                        predicted |= self.predicted[symbol]
+                        for pr, pdot in self.predictions[symbol]:
+                            new_item = (pr, pdot, i)
+                            if new_item not in seen:
+                                seen.add(new_item)
+                                items.append(new_item)
+                    if nullable[symbol]:
+                        new_item = (r, dot + 1, origin)
+                        if new_item not in seen:
+                            seen.add(new_item)
+                            items.append(new_item)
+                elif origin != i:
+                    # Completions of nullable variables at their own origin were already
+                    # advanced over when the waiting items were processed
+                    top = topmost(origin, heads[r])
+                    if top is not None:
+                        if top not in seen:
+                            seen.add(top)
+                            items.append(top)
+                        continue
+                    for wr, wdot, worigin in waiting[origin].get(heads[r], ()):
+                        new_item = (wr, wdot + 1, worigin)
+                        if new_item not in seen:
+                            seen.add(new_item)
+                            items.append(new_item)
+            items = list(dict.fromkeys(scanned))
+        return sets, links
+
+    def recognize(self, string):
+        """
+        Checks if the grammar can generate the passed string.
+        """
+        tokens = self.tokenize(string)
+        if tokens is None or self.start is None:
+            return False
+        if not tokens:
+            return self.nullable[self.start]
+        sets, links = self.chart(tokens)
+        if instrument.enabled:
+            instrument.count("EarleyParser.recognize.calls")
+            instrument.count("EarleyParser.recognize.tokens", len(tokens))
+            instrument.count("EarleyParser.recognize.items", sum(len(items) for items in sets))
+        return self._accepted(sets, len(tokens))
+
+    def _accepted(self, sets, n):
+        return any(self.heads[r] == self.start and dot == len(self.bodies[r]) and origin == 0
+                   for r, dot, origin in sets[n])
+
+    def parse(self, string):
+        """
+        Returns the root SPPFNode of the shared packed parse forest of string, or None if the
+        grammar cannot generate it.
+        """
+        tokens = self.tokenize(string)
+        if tokens is None or self.start is None:
+            return None
+        sets, links = self.chart(tokens)
+        n = len(tokens)
+        if not self._accepted(sets, n):
+            return None
+        bodies = self.bodies
+
+        # The sets each incomplete item is in
+        places = {}
+        for position, items in enumerate(sets):
+            for item in items:
+                if item[1] < len(bodies[item[0]]):
+                    places.setdefault(item, []).append(position)
+
+        # Completed variables per end position, as {variable: starts}. The items of the set
+        # that Leo's reductions left out are added back first, by following their links.
+        completed = {}
+
+        def completions(end):
+            by_symbol = completed.get(end)
+            if by_symbol is None:
+                items = sets[end]
+                followed = set()
+                for r, dot, origin in list(items):
+                    if dot == len(bodies[r]) and origin != end:
+                        key = (origin, self.heads[r])
+                        while key in links and key not in followed:
+                            followed.add(key)
+                            wr, worigin = links[key]
+                            items.add((wr, len(bodies[wr]), worigin))
+                            key = (worigin, self.heads[wr])
+                by_symbol = completed[end] = {}
+                for r, dot, origin in items:
+                    if dot == len(bodies[r]):
+                        by_symbol.setdefault(self.heads[r], set()).add(origin)
+            return by_symbol
+
+        # Nodes are created on first use and their families filled from a worklist, so deep
+        # derivations need no recursion. Symbol nodes are keyed (symbol, start, end) and
+        # intermediate nodes (rule, dot, start, end).
+        nodes = {}
+        pending = []
+
+        def node(key):
+            found = nodes.get(key)
+            if found is None:
+                if len(key) == 3:
+                    label = self.names[key[0]]
+                else:
+                    r, dot = key[0], key[1]
+                    label = (self.names[self.heads[r]], tuple(self.names[symbol] for symbol in self.bodies[r]), dot)
+                found = nodes[key] = SPPFNode(label, key[-2], key[-1])
+                pending.append(key)
+            return found
+
+        root = node((self.start, 0, n))
+        while pending:
+            key = pending.pop()
+            families = nodes[key].families
+            if len(key) == 3:
+                symbol, start, end = key
+                if symbol >= self.variable_count or start not in completions(end).get(symbol, ()):
+                    continue
+                for r in self.rules_of[symbol]:
+                    if (r, len(bodies[r]), start) in sets[end]:
+                        families.append((node((r, len(bodies[r]), start, end)),))
+                continue
+
+            r, dot, start, end = key
+            if dot == 0:
+                families.append(())
+                continue
+            symbol = bodies[r][dot - 1]
+            if symbol >= self.variable_count:
+                starts = (end - 1,) if end > start and tokens[end - 1] == symbol else ()
+            else:
+                starts = completions(end).get(symbol, ())
+            # Split points are where the shorter prefix ends and the last symbol starts, found
+            # from whichever of the two is known at fewer positions
+            prefix_ends = places.get((r, dot - 1, start), ())
+            if len(prefix_ends) <= len(starts):
+                splits = [middle for middle in prefix_ends if middle in starts]
+            else:
+                splits = sorted(middle for middle in starts if (r, dot - 1, start) in sets[middle])
+            for middle in splits:
+                if dot == 1 and middle != start:
+                    continue
+                last = node((symbol, middle, end))
+                if dot == 1:
+                    families.append((last,))
+                else:
+                    families.append((node((r, dot - 1, start, middle)), last))
+
+        return root
 
 class ContextFreeGrammar:
     def __init__(self,
@@ -72,7 +590,12 @@ class ContextFreeGrammar:
         self.accepts_null = None
         self.rules = rules
         self._is_chomsky = None
-        self._cnf = None
+        self._cnf_state = None
+        self._compiled = None
+        self._earley = None
+        self._symbol_names = []
+        self._symbol_ids = {}
+        self._tokens = None
 
     @property
     def variables(self):
@@ -80,9 +603,13 @@ class ContextFreeGrammar:
 
     @variables.setter
     def variables(self, new_variables):
-        if type(new_variables) is not set:
+        if type(new_variables) not in (set, frozenset):
             raise TypeError("Variables must be a set.")
 
+        new_variables = frozenset(new_variables)
+        if new_variables == getattr(self, '_variables', None):
+            return
+
         for variable in new_variables:
             if type(variable) is not str:
                 raise TypeError("Variables must be strings.")
@@ -94,12 +621,11 @@ class ContextFreeGrammar:
         new_variables_list = list(new_variables)
         for i in range(len(new_variables_list) - 1):
             for j in range(i + 1, len(new_variables_list)):
-                if contain_each_other(new_variables_list[i], new_variables_list[j]):
+                if contain_each_other(new_variables_list[i], new_variables_list[j])[0]:
                    raise ValueError("Terminals cannot contain each other.")
 
-        self._variables = frozenset(new_variables)
+        self._variables = new_variables
         self._is_chomsky = None
-        self._cnf = None
         self.accepts_null = None
 
     @property
@@ -108,9 +634,13 @@ class ContextFreeGrammar:
 
     @terminals.setter
     def terminals(self, new_terminals):
-        if type(new_terminals) is not set:
+        if type(new_terminals) not in (set, frozenset):
             raise TypeError("Terminals must be a set.")
 
+        new_terminals = frozenset(new_terminals)
+        if new_terminals == getattr(self, '_terminals', None):
+            return
+
         for terminal in new_terminals:
             if type(terminal) is not str:
                 raise TypeError("Terminals must be strings.")
@@ -122,12 +652,11 @@ class ContextFreeGrammar:
         new_terminals_list = list(new_terminals)
         for i in range(len(new_terminals_list) - 1):
             for j in range(i + 1, len(new_terminals_list)):
-                if contain_each_other(new_terminals_list[i], new_terminals_list[j]):
+                if contain_each_other(new_terminals_list[i], new_terminals_list[j])[0]:
                    raise ValueError("Terminals cannot contain each other.")
 
-        self._terminals = frozenset(new_terminals)
+        self._terminals = new_terminals
         self._is_chomsky = None
-        self._cnf = None
         self.accepts_null = None
 
     @property
@@ -136,9 +665,13 @@ class ContextFreeGrammar:
 
     @rules.setter
     def rules(self, new_rules):
-        if type(new_rules) is not set:
+        if type(new_rules) not in (set, frozenset):
             raise TypeError("Rules must be a set.")
 
+        new_rules = frozenset(new_rules)
+        if new_rules == getattr(self, '_rules', None):
+            return
+
         for rule in new_rules:
             if type(rule) is not tuple:
                 raise TypeError("Rules must be tuples.")
@@ -149,7 +682,9 @@ class ContextFreeGrammar:
             if has_space(rule[0]) or has_space(rule[1]):
                 raise ValueError("Rules cannot contain white spaces.")
 
-        # Validation and processing logic...
+        self._rules = new_rules
+        self._is_chomsky = None
+        self.accepts_null = None
 
     @property
     def start_variable(self):
@@ -160,12 +695,14 @@ class ContextFreeGrammar:
         if type(new_start_variable) is not str:
             raise TypeError("Start variable must be a string.")
 
+        if new_start_variable == getattr(self, '_start_variable', None):
+            return
+
         if new_start_variable not in self.variables:
             raise ValueError("Start variable must be in the variables set.")
 
         self._start_variable = new_start_variable
         self._is_chomsky = None
-        self._cnf = None
         self.accepts_null = None
 
     @property
@@ -177,134 +714,177 @@ class ContextFreeGrammar:
         if type(new_null_character) is not str:
             raise TypeError("Null character must be a string.")
 
+        if new_null_character == getattr(self, '_null_character', None):
+            return
+
         if new_null_character not in self.terminals:
             raise ValueError("Null character must be in the terminals set.")
 
         self._null_character = new_null_character
         self._is_chomsky = None
-        self._cnf = None
         self.accepts_null = None
 
+    def _intern(self, symbol):
+        """
+        Returns the integer id of a symbol, giving it the next free id on first use.
+        """
+        symbol_id = self._symbol_ids.get(symbol)
+        if symbol_id is None:
+            symbol_id = self._symbol_ids[symbol] = len(self._symbol_names)
+            self._symbol_names.append(symbol)
+        return symbol_id
+
+    def _tokenized(self):
+        """
+        Returns the rules as (variable id, symbol ids) pairs of interned integer ids. The rules are
+        split into symbols once and reused while the rules, variables and terminals do not change.
+        """
+        key = (self.rules, self.variables, self.terminals)
+        if self._tokens is not None and self._tokens[0] == key:
+            return self._tokens[1]
+
+        symbol_table = self._symbol_table()
+        intern = self._intern
+        tokens = set()
+        for var, rule in self.rules:
+            rule_symbols = split_symbols(rule, symbol_table)
+            if rule_symbols is None:
+                raise ValueError("Rule {} -> {} cannot be split into symbols.".format(var, rule))
+            tokens.add((intern(var), tuple(intern(symbol) for symbol in rule_symbols)))
+
+        tokens = frozenset(tokens)
+        self._tokens = (key, tokens)
+        return tokens
+
+    def _set_tokenized(self, tokens, variables=None, terminals=None):
+        """
+        Replaces the rules, and optionally the variables and terminals, with tokenized ones.
+        """
+        names = self._symbol_names
+        if variables is not None:
+            self._variables = frozenset(names[var] for var in variables)
+        if terminals is not None:
+            self._terminals = frozenset(names[terminal] for terminal in terminals)
+        tokens = frozenset(tokens)
+        self._rules = frozenset((names[var], ''.join(names[symbol] for symbol in body)) for var, body in tokens)
+        self._tokens = ((self._rules, self._variables, self._terminals), tokens)
+
+    def _nullable_variables(self):
+        """
+        Returns the ids of the variables that derive the null character.
+        """
+        tokens = self._tokenized()
+        null_rule = (self._intern(self.null_character),)
+        nullable = {var for var, body in tokens if body == null_rule}
+        while True:
+            new_nullable = {var for var, body in tokens
+                            if var not in nullable and body and all(symbol in nullable for symbol in body)}
+            if not new_nullable:
+                return nullable
+            nullable |= new_nullable
+
     def remove_null_rules(self):
         """
         Removes null rules from grammar.
         """
-        nullable_vars = {rule[0] for rule in self.rules if rule[1] == self.null_character}
+        tokens = self._tokenized()
+        null_rule = (self._intern(self.null_character),)
 
-        if not nullable_vars:
+        if not any(body == null_rule for _, body in tokens):
             return
 
-        while True:
-            is_nullable = re.compile('({})+'.format('|'.join(re.escape(var) for var in nullable_vars)))
-            new_nullable_vars = {rule[0] for rule in self.rules if is_nullable.fullmatch(rule[1])}
-            new_set = nullable_vars | new_nullable_vars
-            if new_set == nullable_vars:
-                break
-            nullable_vars = new_set
-
-        contains_nullable = re.compile('({})'.format('|'.join(re.escape(var) for var in nullable_vars)))
+        nullable_vars = self._nullable_variables()
 
         new_rules = set()
 
-        for rule in self.rules:
-            if rule[1] == self.null_character:
+        for var, body in tokens:
+            if body == null_rule:
                 continue
-            splits = contains_nullable.split(rule[1])
-            if splits[0] != rule[1]:
-                splits = [[x, False] for x in splits if x != '']
-
-                def tree_search(node):
-                    if not node.value:
-                        return
-                    children = node.children(contains_nullable)
-                    if not children:
-                        new_rules.add((rule[0], (''.join((val[0] for val in node.value)))))
-                    else:
-                        for child in children:
-                            tree_search(child)
-
-                tree_search(RuleTreeNode(splits))
-            new_rules.add(rule)
+            # Every combination of the nullable occurrences is either kept or left out
+            optional = [i for i, symbol in enumerate(body) if symbol in nullable_vars]
+            for left_out in product((False, True), repeat=len(optional)):
+                removed = {i for i, leave in zip(optional, left_out) if leave}
+                new_body = tuple(symbol for i, symbol in enumerate(body) if i not in removed)
+                if new_body:
+                    new_rules.add((var, new_body))
 
-        self._rules = frozenset(new_rules)
+        self._set_tokenized(new_rules)
 
     def remove_unit_rules(self):
         """
         Removes unit rules from grammar.
         """
+        tokens = self._tokenized()
+        variables = {self._intern(var) for var in self.variables}
+
+        unit_rules = {}
+        non_unit_rules = {}
+        for var, body in tokens:
+            if len(body) == 1 and body[0] in variables:
+                unit_rules.setdefault(var, set()).add(body[0])
+            else:
+                non_unit_rules.setdefault(var, set()).add(body)
 
-        def get_related_unit_rules(var, var_related_unit_rules):
-            prev_related_unit_rules = copy(var_related_unit_rules)
-            var_unit_rules = self._var_unit_rules(var)
-            var_related_unit_rules |= var_unit_rules
-            for unit_var in var_unit_rules - prev_related_unit_rules:
-                get_related_unit_rules(unit_var, var_related_unit_rules)
-
-        related_unit_rules = dict([(var, set()) for var in self.variables])
-
-        for var in self.variables:
-            get_related_unit_rules(var, related_unit_rules[var])
-            related_unit_rules[var] -= {var}
-
-        non_unit_rules = {(var, rule) for var in self.variables for rule in self._var_none_unit_rules(var)}
-
-        for var in self.variables:
-            for related_var in related_unit_rules[var]:
-                non_unit_rules |= {(var, related_var_non_unit_rule) for related_var_non_unit_rule
-                                   in self._var_none_unit_rules(related_var)}
-
-        self._rules = frozenset(non_unit_rules)
+        new_rules = set()
+        for var in variables:
+            related_vars = {var}
+            stack = [var]
+            while stack:
+                for unit_var in unit_rules.get(stack.pop(), ()):
+                    if unit_var not in related_vars:
+                        related_vars.add(unit_var)
+                        stack.append(unit_var)
+            for related_var in related_vars:
+                new_rules |= {(var, body) for body in non_unit_rules.get(related_var, ())}
+
+        self._set_tokenized(new_rules)
 
     def reduct(self):
         """
         Reducts grammar's rules.
         """
+        tokens = self._tokenized()
+        intern = self._intern
+        variables = {intern(var) for var in self.variables}
+        terminals = {intern(terminal) for terminal in self.terminals}
+
         """
         Phase 1
         """
         v1 = set()
         while True:
-            v1_union_t = v1 | self.terminals
-            v1_union_t_pattern = re.compile('({})+'.format('|'.join(re.escape(val) for val in v1_union_t)))
-            prev_v1 = deepcopy(v1)
-            for var in self.variables:
-                if {rule for rule in self.rules if rule[0] == var and v1_union_t_pattern.fullmatch(rule[1])}:
-                    v1.add(var)
-            if prev_v1 == v1:
+            v1_union_t = v1 | terminals
+            new_vars = {var for var, body in tokens if var in variables and var not in v1
+                        and body and all(symbol in v1_union_t for symbol in body)}
+            if not new_vars:
                 break
-        p1 = {rule for rule in self.rules if v1_union_t_pattern.fullmatch(rule[1])}
-
-        is_rule = re.compile('({})'.format('|'.join(re.escape(val) for val in v1)))
+            v1 |= new_vars
+        v1_union_t = v1 | terminals
+        p1 = {(var, body) for var, body in tokens if body and all(symbol in v1_union_t for symbol in body)}
 
         """
         Phase 2
         """
-
-        def get_related_vars(var, related_vars):
-            var_related_vars = set()
-            for rule in {rule[1] for rule in p1 if rule[0] == var}:
-                var_related_vars |= set(is_rule.findall(rule))
-
-            prev_related_vars = deepcopy(related_vars)
-            related_vars |= var_related_vars
-            for related_var in var_related_vars - prev_related_vars:
-                get_related_vars(related_var, related_vars)
-
-        S_related_vars = set()
-        get_related_vars(self.start_variable, S_related_vars)
-        v1 = S_related_vars
-        v1.add(self.start_variable)
-        is_related_rule = re.compile('|'.join(re.escape(val) for val in v1))
-        p1 -= {rule for rule in p1 if not is_related_rule.fullmatch(rule[0])}
-
-        terminals_pattern = re.compile('|'.join(re.escape(val) for val in self.terminals))
-        t1 = {self.null_character}
-        for rule in p1:
-            t1 |= set(terminals_pattern.findall(rule[1]))
-
-        self._variables = frozenset(v1)
-        self._rules = frozenset(p1)
-        self._terminals = frozenset(t1)
+        bodies = {}
+        for var, body in p1:
+            bodies.setdefault(var, []).append(body)
+
+        start = intern(self.start_variable)
+        related_vars = {start}
+        stack = [start]
+        while stack:
+            for body in bodies.get(stack.pop(), ()):
+                for symbol in body:
+                    if symbol in v1 and symbol not in related_vars:
+                        related_vars.add(symbol)
+                        stack.append(symbol)
+
+        p1 = {(var, body) for var, body in p1 if var in related_vars}
+        t1 = {intern(self.null_character)}
+        for _, body in p1:
+            t1 |= {symbol for symbol in body if symbol in terminals}
+
+        self._set_tokenized(p1, related_vars, t1)
 
     def simplify(self):
         """
@@ -316,43 +896,61 @@ class ContextFreeGrammar:
 
 
     @staticmethod
-    def _generate_variable_names(variables, n, var_name=None):
+    def _generate_variable_names(variables, n, state=None):
+        """
+        Returns n new variable names that do not contain each other or any of the passed
+        variables, and the state to pass back to continue the sequence.
+        Names are a letter base, a number and the base again (A1A, A2A, ...), so a
+        generated name never contains another one however many are needed.
+        """
         def next_variable():
-            nonlocal var_name
             z_index = -1
             for i in range(len(var_name)):
                 if var_name[i] == 'Z':
                     z_index = i
             if z_index == len(var_name) - 1:
-                var_name = ['A' for _ in range(z_index + 2)]
-            else:
-                var_name[z_index] = chr(ord(var_name[z_index]) + 1)
+                return ['A' for _ in range(z_index + 2)]
+            var_name[z_index] = chr(ord(var_name[z_index]) + 1)
             return var_name
 
+        var_name, number = state if state else (['A'], 1)
+        # Once no variable contains the base or is contained in it, a variable can only
+        # contain a name or be contained in one by spanning its digits
+        digit_variables = [var for var in variables if any(char.isdigit() for char in var)]
         variable_names = []
-        if not var_name:
-            var_name = ['A']
-        while True:
-            contain_each_other = False
+        base_checked = False
+        while len(variable_names) < n:
             var_str = ''.join(var_name)
-            for var in variables:
-                contain_each_other, _, _ = contain_each_other(var, var_str)
-                if contain_each_other:
-                    break
-            if contain_each_other:
-                next_variable()
-            else:
-                variable_names.extend([var_str + str(i) for i in range(1, 10)])
-                next_variable()
-                if len(variable_names) >= n:
-                    break
-
-        return variable_names[:n], var_name
+            if not base_checked:
+                if any(contain_each_other(var, var_str)[0] for var in variables):
+                    var_name, number = next_variable(), 1
+                    continue
+                base_checked = True
+            name = var_str + str(number) + var_str
+            number += 1
+            if not any(contain_each_other(var, name)[0] for var in digit_variables):
+                variable_names.append(name)
+
+        return variable_names, (var_name, number)
 
     def convert_to_cnf(self):
         """
         Converts the grammar to Chomsky normal form (CNF).
         """
+        if instrument.enabled:
+            rules = len(self.rules)
+            start = time.perf_counter()
+            self._convert_to_cnf()
+            instrument.addtime("ContextFreeGrammar.convert_to_cnf", time.perf_counter() - start)
+            instrument.count("ContextFreeGrammar.convert_to_cnf.rules_in", rules)
+            instrument.count("ContextFreeGrammar.convert_to_cnf.rules_out", len(self.rules))
+            return
+        self._convert_to_cnf()
+
+    def _convert_to_cnf(self):
+        """
+        Does the conversion of convert_to_cnf.
+        """
         last_checked_variable = None
         free_variables = []
 
@@ -372,109 +970,174 @@ class ContextFreeGrammar:
         """
         Phase 1
         """
+        accepts_null = self._intern(self.start_variable) in self._nullable_variables()
         self.simplify()
 
-        v1 = set(self.variables)
+        tokens = self._tokenized()
+        intern = self._intern
+        names = self._symbol_names
+        v1 = {intern(var) for var in self.variables}
+        terminals = {intern(terminal) for terminal in self.terminals}
         p1 = set()
         p2 = set()
 
-        is_terminal = re.compile('|'.join(map(re.escape, self.terminals)))
+        bodies = {}
+        for var, body in tokens:
+            bodies.setdefault(var, []).append(body)
 
         terminal_rules = {}
-        for var in self.variables:
-            var_rules = [rule[1] for rule in self.rules if rule[0] == var]
-            if len(var_rules) == 1:
-                if is_terminal.fullmatch(var_rules[0]):
-                    terminal_rules[var_rules[0]] = var
-
-        for rule in self.rules:
-            if is_terminal.fullmatch(rule[1]):
-                p2.add(rule)
+        for var in sorted(v1, key=names.__getitem__):
+            var_rules = bodies.get(var, [])
+            if len(var_rules) == 1 and len(var_rules[0]) == 1 and var_rules[0][0] in terminals:
+                terminal_rules[var_rules[0][0]] = var
+
+        for var, body in sorted(tokens):
+            if len(body) == 1 and body[0] in terminals:
+                p2.add((var, body))
+            elif not any(symbol in terminals for symbol in body):
+                p1.add((var, body))
             else:
-                rule_terminals = is_terminal.findall(rule[1])
-                if not rule_terminals:
-                    p1.add(rule)
-                else:
-                    old_rule = rule[1]
-                    for rule_terminal in rule_terminals:
-                        if not terminal_rules.get(rule_terminal, None):
-                            new_var = new_variable()
-                            terminal_rules[rule_terminal] = new_var
-                            p2.add((new_var, rule_terminal))
+                new_body = []
+                for symbol in body:
+                    if symbol in terminals:
+                        if symbol not in terminal_rules:
+                            new_var = intern(new_variable())
+                            terminal_rules[symbol] = new_var
+                            p2.add((new_var, (symbol,)))
                             v1.add(new_var)
-                        old_rule = old_rule.replace(rule_terminal, terminal_rules[rule_terminal])
-
-                    p1.add((rule[0], old_rule))
+                        symbol = terminal_rules[symbol]
+                    new_body.append(symbol)
+                p1.add((var, tuple(new_body)))
 
         """
         Phase 2
         """
-        variables_pattern = re.compile('|'.join(map(re.escape, v1)))
-        for rule in p1:
-            rule_variables = variables_pattern.findall(rule[1])
-            if len(rule_variables) == 2:
-                p2.add(rule)
+        for var, body in sorted(p1):
+            if len(body) <= 2:
+                p2.add((var, body))
             else:
-                new_vars = [new_variable() for _ in range(len(rule_variables) - 2)]
-                p2.add((rule[0], rule_variables.pop(0) + new_vars[-1]))
-                for i in range(len(new_vars) - 2):
-                    p2.add((new_vars[i], new_vars.pop(0) + new_vars[i + 1]))
-                a = rule_variables.pop()
-                b = rule_variables.pop()
-                p2.add((new_vars[-1], b + a))
+                new_vars = [intern(new_variable()) for _ in range(len(body) - 2)]
+                p2.add((var, (body[0], new_vars[0])))
+                for i in range(len(new_vars) - 1):
+                    p2.add((new_vars[i], (body[i + 1], new_vars[i + 1])))
+                p2.add((new_vars[-1], (body[-2], body[-1])))
                 v1 |= set(new_vars)
 
-        self.variables = frozenset(v1)
-        self.rules = frozenset(p2)
-        self._is_cnf = True
+        # Generated names never contain each other or the grammar's variables, so the variables
+        # setter's pairwise check is skipped
+        self._set_tokenized(p2, v1)
+        # Null rules are removed, so whether the original grammar accepted the empty string is
+        # kept next to the grammar it was converted to
+        self._cnf_state = (self._grammar_key(), accepts_null)
 
     def cyk_algorithm(self, string):
         """
         Checks if the grammar can generate the passed string or not using the Cocke–Younger–Kasami (CYK) algorithm.
         """
-        string = string.strip()
-
-        if not self._is_cnf:
-            if not self._cnf:
-                self._cnf = copy.deepcopy(self)
-                self._cnf.convert_to_cnf()
-            self = self._cnf
-
-        if string == '':
-            if self.null_character:
-                return True
-            return False
-
-        if string == self.null_character:
-            return False
+        if instrument.enabled:
+            start = time.perf_counter()
+            result = self.compile().accepts(string.strip())
+            instrument.addtime("ContextFreeGrammar.cyk_algorithm", time.perf_counter() - start)
+            return result
+        return self.compile().accepts(string.strip())
+
+    def _grammar_key(self):
+        """
+        Returns the parts of the grammar compiled forms depend on. They are immutable, so a cached
+        form stays valid while its key compares equal.
+        """
+        return self.rules, self.variables, self.terminals, self.start_variable, self.null_character
 
-        V = [[set() if i != j else {rule[0] for rule in self.rules if rule[1] == string[i]}
-              for j in range(len(string))]
-             for i in range(len(string))]
+    def compile(self):
+        """
+        Returns a CYKRecognizer for the grammar. The grammar is converted to CNF on a copy unless it
+        already is in CNF, and the recognizer is reused until the rules, variables, terminals, start
+        variable or null character change.
+        """
+        key = self._grammar_key()
+        if self._compiled is not None and self._compiled[0] == key:
+            return self._compiled[1]
 
-        variables_pattern = re.compile('|'.join(map(re.escape, self.variables)))
+        start = time.perf_counter() if instrument.enabled else None
+        if self._cnf_state is not None and self._cnf_state[0] == key:
+            cnf, accepts_null = self, self._cnf_state[1]
+        else:
+            cnf = copy(self)
+            cnf._compiled = None
+            cnf._earley = None
+            cnf._symbol_ids = dict(self._symbol_ids)
+            cnf._symbol_names = list(self._symbol_names)
+            cnf.convert_to_cnf()
+            accepts_null = cnf._cnf_state[1]
+
+        start_bit, terminal, binary = cnf._cyk_tables()
+        recognizer = CYKRecognizer(start_bit, accepts_null, cnf.null_character, terminal, binary)
+        self._compiled = (key, recognizer)
+        self.accepts_null = accepts_null
+        if start is not None:
+            instrument.addtime("ContextFreeGrammar.compile", time.perf_counter() - start)
+        return recognizer
+
+    def earley_parser(self):
+        """
+        Returns an EarleyParser for the grammar's rules as they are, reused until the rules,
+        variables, terminals, start variable or null character change.
+        """
+        key = self._grammar_key()
+        if self._earley is None or self._earley[0] != key:
+            self._earley = (key, EarleyParser(self))
+        return self._earley[1]
 
-        def Vij(i, j):
-            """
-            Calculates V[i][j].
-            """
-            nonlocal V
+    def earley_algorithm(self, string):
+        """
+        Checks if the grammar can generate the passed string or not using the Earley algorithm,
+        without converting the grammar to CNF.
+        """
+        if instrument.enabled:
+            start = time.perf_counter()
+            result = self.earley_parser().recognize(string.strip())
+            instrument.addtime("ContextFreeGrammar.earley_algorithm", time.perf_counter() - start)
+            return result
+        return self.earley_parser().recognize(string.strip())
+
+    def parse_forest(self, string):
+        """
+        Returns the shared packed parse forest of the passed string as an SPPFNode, or None if the
+        grammar cannot generate it.
+        """
+        return self.earley_parser().parse(string.strip())
 
-            for k in range(i, j):
-                for rule in self.rules:
-                    rule_variables = variables_pattern.findall(rule[1])
-                    if len(rule_variables) == 2:
-                        if rule_variables[0] in V[i][k] and rule_variables[1] in V[k + 1][j]:
-                            V[i][j].add(rule[0])
+    def _symbol_table(self):
+        """
+        Returns a dictionary from first characters to the variables and terminals starting with
+        them, variables first, for split_symbols.
+        """
+        symbol_table = {}
+        for symbol in sorted(self.variables) + sorted(self.terminals):
+            symbol_table.setdefault(symbol[0], []).append(symbol)
+        return symbol_table
 
-        for j in range(len(string) - 1):
-            for i in range(len(string)):
-                if i + 1 + j < len(string):
-                    Vij(i, i + 1 + j)
+    def _cyk_tables(self):
+        """
+        Returns the CYK indexes of the CNF grammar, with variables numbered by integer bits and sets
+        of variables stored as int bitmasks: the bit of the start variable, the terminal rules as
+        {a: A mask} and the binary rules as {B: {C: A mask}}.
+        """
+        names = self._symbol_names
+        bits = {self._intern(var): i for i, var in enumerate(sorted(self.variables))}
+        terminals = {self._intern(terminal) for terminal in self.terminals}
+        terminal = {}
+        binary = {}
+        for var, body in self._tokenized():
+            if var not in bits:
+                continue
+            if len(body) == 1 and body[0] in terminals:
+                terminal[names[body[0]]] = terminal.get(names[body[0]], 0) | 1 << bits[var]
+            elif len(body) == 2 and body[0] in bits and body[1] in bits:
+                row = binary.setdefault(bits[body[0]], {})
+                row[bits[body[1]]] = row.get(bits[body[1]], 0) | 1 << bits[var]
 
-        if self.start_variable in V[0][-1]:
-            return True
-        return False
+        return bits.get(self._intern(self.start_variable)), terminal, binary
 
     def stringify_rules(self, *, return_list=False, prepend='', line_splitter='\n'):
         """
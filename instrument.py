@@ -0,0 +1,84 @@
+import json
+import marshal
+from contextlib import contextmanager
+
+# Instrumentation switch, checked once per call by the instrumented hot paths
+# (Automata.test_string, getEClosures, newBuildFromNumber, newBuildFromStart,
+# ContextFreeGrammar.convert_to_cnf and cyk_algorithm) so that, while it is
+# off, nothing is recorded and they only pay for testing a local flag
+enabled = False
+
+# Counter name -> total
+counters = {}
+
+# Timed section name -> [calls, total seconds]
+timings = {}
+
+# Turn recording on
+def enable():
+    global enabled
+    enabled = True
+
+# Turn recording off, the recorded data is kept
+def disable():
+    global enabled
+    enabled = False
+
+# Forget all recorded counters and timings
+def reset():
+    counters.clear()
+    timings.clear()
+
+# Add amount to a counter
+def count(name, amount=1):
+    counters[name] = counters.get(name, 0) + amount
+
+# Record one call of a timed section
+def addtime(name, seconds):
+    entry = timings.get(name)
+    if entry is None:
+        timings[name] = [1, seconds]
+    else:
+        entry[0] += 1
+        entry[1] += seconds
+
+# Reset and record everything inside the block, then restore the previous state
+# with instrument.recording():
+#     nfa.test_string(text)
+# print(instrument.report())
+@contextmanager
+def recording():
+    global enabled
+    previous = enabled
+    reset()
+    enabled = True
+    try:
+        yield
+    finally:
+        enabled = previous
+
+# Return the recorded data as plain dicts
+def report():
+    return {
+        "counters": dict(counters),
+        "timings": {name: {"calls": calls, "seconds": seconds}
+                    for name, (calls, seconds) in timings.items()},
+    }
+
+# Write the recorded data as JSON to a path or an open text file
+def dump_json(target):
+    if hasattr(target, "write"):
+        json.dump(report(), target, indent=2, sort_keys=True)
+        return
+    with open(target, "w") as outfile:
+        json.dump(report(), outfile, indent=2, sort_keys=True)
+
+# Write the timings in the marshal format of cProfile.Profile.dump_stats so
+# they can be read with pstats.Stats(path) or any cProfile viewer
+# Every timed section becomes one function entry named after the section
+def dump_stats(path):
+    stats = {}
+    for name, (calls, seconds) in timings.items():
+        stats[("instrument", 0, name)] = (calls, calls, seconds, seconds, {})
+    with open(path, "wb") as outfile:
+        marshal.dump(stats, outfile)
@@ -1,46 +1,114 @@
 import tkinter as tk
 from tkinter import messagebox
 from tkinter.font import Font 
-from regex_to_NFA import NFAfromRegex, Automata, BuildAutomata
+from regex_to_NFA import Automata, BuildAutomata, compile_regex
 import graphviz
 from PIL import Image, ImageTk
+import io
 import os
+import queue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Rendered diagrams kept in memory, by regex
+IMAGE_CACHE_SIZE = 32
+
+# Milliseconds between two checks for finished renders and tests
+POLL_INTERVAL = 50
+
+# One background thread builds, renders and tests, so the Tk thread never blocks
+render_executor = ThreadPoolExecutor(max_workers=1)
+worker_results = queue.Queue()
+image_cache = OrderedDict()
+
+# Bumped on every build request and every edit of the regex, a render or test
+# whose generation is no longer current is cancelled or its result dropped
+generation = 0
+
+def cancel_render(*args):
+    global generation
+    generation += 1
+
+def render_diagram(regex, job):
+    # Runs on the worker thread: build the NFA and render its diagram to PNG
+    # bytes in memory, checking for cancellation between the steps
+    try:
+        if job != generation:
+            return
+        nfa = compile_regex(regex)
+        if job != generation:
+            return
+        png = graphviz.Source(nfa.to_dot(), format='png').pipe()
+        if job != generation:
+            return
+        nfa_image = Image.open(io.BytesIO(png))
+        nfa_image = nfa_image.resize((400, 400), Image.LANCZOS)  # Resize the image as needed
+        worker_results.put((job, "render", regex, nfa_image, None))
+    except Exception as error:
+        worker_results.put((job, "render", regex, None, error))
+
+def run_test(regex, test_input, job):
+    # Runs on the worker thread: build the NFA, or take it from the cache, and
+    # test the string against it
+    try:
+        if job != generation:
+            return
+        valid = compile_regex(regex).test_string(test_input)
+        worker_results.put((job, "test", regex, (test_input, valid), None))
+    except Exception as error:
+        worker_results.put((job, "test", regex, None, error))
+
+def poll_results():
+    # Runs on the Tk thread through root.after: show finished renders and tests
+    while True:
+        try:
+            job, kind, regex, result, error = worker_results.get_nowait()
+        except queue.Empty:
+            break
+        if kind == "render" and error is None:
+            image_cache[regex] = result
+            while len(image_cache) > IMAGE_CACHE_SIZE:
+                image_cache.popitem(last=False)
+        if job != generation:
+            continue
+        if error is not None:
+            output_label.config(text=f"Could not build the NFA: {error}")
+        elif kind == "render":
+            show_diagram(result)
+            output_label.config(text="NFA Built Successfully.")
+        else:
+            test_input, valid = result
+            if valid:
+                output_label.config(text=f"'{test_input}' is valid for the regex '{regex}'.")
+            else:
+                output_label.config(text=f"'{test_input}' is not valid for the regex '{regex}'.")
+    root.after(POLL_INTERVAL, poll_results)
+
+def show_diagram(nfa_image):
+    nfa_photo = ImageTk.PhotoImage(nfa_image)
+    nfa_image_label.config(image=nfa_photo)
+    nfa_image_label.image = nfa_photo  # Keep a reference to prevent garbage collection
 
 def build_nfa():
     regex = regex_entry.get()
     if regex:
-        nfa_builder = NFAfromRegex(regex)
-        nfa = nfa_builder.getNFA()
-        output_label.config(text="NFA Built Successfully.")
-
-        # Generate DOT code
-        dot_code = nfa.to_dot()
-
-        # Render DOT code to PNG image
-        graph = graphviz.Source(dot_code, format='png')
-        graph.render(filename='nfa_diagram', directory='.')
-
-        # Display the image in GUI
-        nfa_image = Image.open('nfa_diagram.png')
-        nfa_image = nfa_image.resize((400, 400), Image.ANTIALIAS)  # Resize the image as needed
-        nfa_photo = ImageTk.PhotoImage(nfa_image)
-
-        # Create a label to display the image
-        nfa_image_label = tk.Label(root, image=nfa_photo)
-        nfa_image_label.image = nfa_photo  # Keep a reference to prevent garbage collection
-        nfa_image_label.pack()
+        cancel_render()
+        if regex in image_cache:
+            image_cache.move_to_end(regex)
+            show_diagram(image_cache[regex])
+            output_label.config(text="NFA Built Successfully.")
+            return
+        output_label.config(text="Building NFA...")
+        render_executor.submit(render_diagram, regex, generation)
     else:
         messagebox.showerror("Error", "Please enter a regex.")
 
 def test_string():
     test_input = test_entry.get()
     if test_input:
-        nfa_builder = NFAfromRegex(regex_entry.get())  # Create an NFA builder from the regex
-        nfa = nfa_builder.getNFA()  # Get the NFA from the builder
-        if nfa.test_string(test_input):
-            output_label.config(text=f"'{test_input}' is valid for the regex '{regex_entry.get()}'.")
-        else:
-            output_label.config(text=f"'{test_input}' is not valid for the regex '{regex_entry.get()}'.")
+        # A pending build is not cancelled, the test runs after it on the worker
+        output_label.config(text="Testing string...")
+        render_executor.submit(run_test, regex_entry.get(), test_input, generation)
     else:
         messagebox.showerror("Error", "Please enter a string to test.")
 
@@ -65,7 +133,9 @@ font_style = Font(family="Helvetica", size=20, weight="bold")  # Create a Font o
 regex_label = tk.Label(root, text="Enter the regex:", font=font_style, bg="#223D60",fg="white")  # Set background color
 regex_label.pack(padx=20, pady=10) 
 
-regex_entry = tk.Entry(root, width=30)  # Increase width of the text field
+regex_var = tk.StringVar()
+regex_var.trace_add("write", cancel_render)  # Editing the regex cancels the pending render
+regex_entry = tk.Entry(root, width=30, textvariable=regex_var)  # Increase width of the text field
 regex_entry.pack()
 
 font_style1 = Font(family="Helvetica", size=15)
@@ -86,6 +156,12 @@ test_button.pack(padx=20, pady=30)
 output_label = tk.Label(root, text="",bg="#223D60",font=font_style,fg="#F5EA05")
 output_label.pack()
 
+# The diagram label is created once and gets a new image on every build
+nfa_image_label = tk.Label(root, bg="#223D60")
+nfa_image_label.pack()
+
 # Start the main loop
+root.after(POLL_INTERVAL, poll_results)
 root.mainloop()
+render_executor.shutdown(wait=False, cancel_futures=True)
 
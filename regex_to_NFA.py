@@ -1,4 +1,87 @@
+import argparse
+import mmap
+import os
+import struct
 import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict, deque
+
+import instrument
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Largest Unicode code point, the end of the input alphabet
+MAXCODEPOINT = 0x10FFFF
+
+# Maximum number of characters remembered by a SymbolClasses lookup cache
+CLASSCACHESIZE = 1 << 16
+
+# A lazy DFA is thrashing when, this many flushes in a row, its cache was
+# flushed before reading THRASHRATIO characters per cached state
+THRASHLIMIT = 2
+THRASHRATIO = 2
+
+# Number of strings advanced together by DFATable.match_batch
+BATCHSIZE = 1 << 16
+
+# Binary format of a saved automaton, see save_automaton
+FORMATMAGIC = b"RXDF"
+FORMATVERSION = 1
+FORMATHEADER = struct.Struct("<4sHHiiii")
+
+class CharClass:
+
+    # Character class transition label constructor
+    # Holds sorted, disjoint inclusive code point intervals; a negated class
+    # is stored as its complement so membership is always one bisect
+    def __init__(self, intervals, negated=False, text=None):
+        merged = []
+        for low, high in sorted(intervals):
+            if merged and low <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], high))
+            else:
+                merged.append((low, high))
+        if negated:
+            complement = []
+            low = 0
+            for start, end in merged:
+                if start > low:
+                    complement.append((low, start - 1))
+                low = end + 1
+            if low <= MAXCODEPOINT:
+                complement.append((low, MAXCODEPOINT))
+            merged = complement
+        self.intervals = tuple(merged)
+        self.starts = [low for low, high in merged]
+        self.text = text
+
+    def __contains__(self, char):
+        if not isinstance(char, str) or len(char) != 1:
+            return False
+        code = ord(char)
+        i = bisect_right(self.starts, code) - 1
+        return i >= 0 and code <= self.intervals[i][1]
+
+    def __eq__(self, other):
+        return isinstance(other, CharClass) and self.intervals == other.intervals
+
+    def __hash__(self):
+        return hash(self.intervals)
+
+    def __str__(self):
+        if self.text is not None:
+            return self.text
+        return "[" + "".join(chr(low) if low == high else chr(low) + "-" + chr(high)
+                             for low, high in self.intervals) + "]"
+
+    __repr__ = __str__
 
 class Automata:
 
@@ -9,6 +92,11 @@ class Automata:
         self.finalstates = []
         self.transitions = dict()
         self.language = language
+        self.eclosures = None
+        self.bitsetsimulator = None
+        self.symboltargets = dict()
+        self.epsilonedges = dict()
+        self.classedges = dict()
 
     @staticmethod
     # Get epsilon
@@ -19,21 +107,36 @@ class Automata:
     def setstartstate(self, state):
         self.startstate = state
         self.states.add(state)
+        self.bitsetsimulator = None
 
     # Add to final states list
     def addfinalstates(self, state):
         if isinstance(state, int):
             state = [state]
+        self.bitsetsimulator = None
         for s in state:
             if s not in self.finalstates:
                 self.finalstates.append(s)
 
     # Add transition to transitions dictionary
     def addtransition(self, fromstate, tostate, inp):
-        if isinstance(inp, str):
+        if isinstance(inp, (str, CharClass)):
             inp = set([inp])
+        self.eclosures = None
+        self.bitsetsimulator = None
         self.states.add(fromstate)
         self.states.add(tostate)
+        for symbol in inp:
+            if symbol == Automata.epsilon():
+                edges = self.epsilonedges.setdefault(fromstate, [])
+                if tostate not in edges:
+                    edges.append(tostate)
+            elif isinstance(symbol, CharClass):
+                edges = self.classedges.setdefault(fromstate, [])
+                if (symbol, tostate) not in edges:
+                    edges.append((symbol, tostate))
+            else:
+                self.symboltargets.setdefault((fromstate, symbol), set()).add(tostate)
         if fromstate in self.transitions:
             if tostate in self.transitions[fromstate]:
                 self.transitions[fromstate][tostate] = self.transitions[fromstate][tostate].union(inp)
@@ -49,29 +152,99 @@ class Automata:
                 self.addtransition(fromstate, state, tostates[state])
 
     # Create a transitions set and return it
+    # Looks targets up in the (state, symbol) index instead of scanning edges,
+    # only character class edges are tested one by one
     def gettransitions(self, state, key):
         if isinstance(state, int):
             state = [state]
         trstates = set()
+        if key == Automata.epsilon():
+            for st in state:
+                if st in self.epsilonedges:
+                    trstates.update(self.epsilonedges[st])
+            return trstates
         for st in state:
-            if st in self.transitions:
-                for tns in self.transitions[st]:
-                    if key in self.transitions[st][tns]:
+            if (st, key) in self.symboltargets:
+                trstates.update(self.symboltargets[(st, key)])
+            if st in self.classedges:
+                for charclass, tns in self.classedges[st]:
+                    if key in charclass:
                         trstates.add(tns)
         return trstates
 
     # Get epsilon closure
     def getEClose(self, findstate):
-        allstates = set()
-        states = set([findstate])
-        while len(states)!= 0:
-            state = states.pop()
-            allstates.add(state)
-            if state in self.transitions:
-                for tns in self.transitions[state]:
-                    if Automata.epsilon() in self.transitions[state][tns] and tns not in allstates:
-                        states.add(tns)
-        return allstates
+        closures = self.getEClosures()
+        if findstate in closures:
+            return set(closures[findstate])
+        return set([findstate])
+
+    # Return the epsilon closure table, computing it if the graph has changed
+    def getEClosures(self):
+        if self.eclosures is not None:
+            return self.eclosures
+        if instrument.enabled:
+            instrument.count("Automata.getEClosures.computations")
+            instrument.count("Automata.getEClosures.states", len(self.states))
+            start = time.perf_counter()
+            self.computeEClosures()
+            instrument.addtime("Automata.getEClosures", time.perf_counter() - start)
+            return self.eclosures
+        return self.computeEClosures()
+
+    # Compute and store the epsilon closure table
+    # Closures are found in one pass: Tarjan's algorithm yields the strongly
+    # connected components of the epsilon graph in reverse topological order,
+    # so every component only unions closures that are already complete
+    def computeEClosures(self):
+        successors = self.epsilonedges
+        index = {}
+        lowlink = {}
+        stack = []
+        onstack = set()
+        closures = {}
+        counter = 0
+        for root in self.states:
+            if root in index:
+                continue
+            work = [(root, 0)]
+            while work:
+                state, i = work.pop()
+                if i == 0:
+                    index[state] = lowlink[state] = counter
+                    counter += 1
+                    stack.append(state)
+                    onstack.add(state)
+                edges = successors.get(state, ())
+                if i < len(edges):
+                    work.append((state, i + 1))
+                    tns = edges[i]
+                    if tns not in index:
+                        work.append((tns, 0))
+                    elif tns in onstack:
+                        lowlink[state] = min(lowlink[state], index[tns])
+                    continue
+                if lowlink[state] == index[state]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        onstack.discard(member)
+                        component.append(member)
+                        if member == state:
+                            break
+                    closure = set(component)
+                    for member in component:
+                        for tns in successors.get(member, ()):
+                            if tns not in onstack and tns in closures and tns not in closure:
+                                closure |= closures[tns]
+                    closure = frozenset(closure)
+                    for member in component:
+                        closures[member] = closure
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[state])
+        self.eclosures = closures
+        return closures
 
     # Write NFA data to file
     # Starting state is 1 so decrement all states by 1
@@ -106,25 +279,196 @@ class Automata:
                 for inp in inputs:
                     print(f"{fromstate} --({inp})--> {tostate}")
 
+    # While instrumentation is enabled, also records how many states are expanded
+    # per character and how many epsilon closures are unioned
     def test_string(self, input_string):
-        current_states = self.getEClose(self.startstate)  # Get epsilon closure of the start state
-
-        # Check if the start state is a final state and the input string is empty
-        if input_string == "" and self.startstate in self.finalstates:
-            return True
+        recording = instrument.enabled
+        if recording:
+            begin = time.perf_counter()
+            expanded = 0
+            unions = 0
+        closures = self.getEClosures()
+        current_states = closures.get(self.startstate, frozenset([self.startstate]))  # Get epsilon closure of the start state
+        peak = len(current_states)
 
+        symboltargets = self.symboltargets
+        classedges = self.classedges
         for symbol in input_string:
+            if recording:
+                expanded += len(current_states)
             next_states = set()
             for state in current_states:
-                next_states |= self.gettransitions(state, symbol)  # Union of transitions from current states
+                targets = symboltargets.get((state, symbol))  # Union of transitions from current states
+                if targets:
+                    next_states |= targets
+                if classedges and state in classedges:
+                    for charclass, target in classedges[state]:
+                        if symbol in charclass:
+                            next_states.add(target)
             current_states = set()
             for state in next_states:
-                current_states |= self.getEClose(state)  # Get epsilon closure of next states
+                current_states |= closures[state]  # Get epsilon closure of next states
+            if recording:
+                unions += len(next_states)
+                peak = max(peak, len(current_states))
         # Check if any of the final states is in the current set of states
-        for final_state in self.finalstates:
-            if final_state in current_states:
-                return True  # String is valid
-        return False  # String is not valid
+        result = any(final_state in current_states for final_state in self.finalstates)
+        if recording:
+            instrument.count("Automata.test_string.calls")
+            instrument.count("Automata.test_string.characters", len(input_string))
+            instrument.count("Automata.test_string.states_expanded", expanded)
+            instrument.count("Automata.test_string.closure_unions", unions)
+            instrument.counters["Automata.test_string.peak_states"] = max(
+                peak, instrument.counters.get("Automata.test_string.peak_states", 0))
+            instrument.addtime("Automata.test_string", time.perf_counter() - begin)
+        return result
+
+    # Test every string of an iterable, yielding (string, result) pairs
+    def match_many(self, strings):
+        for string in strings:
+            yield string, self.test_string(string)
+
+    # Find all non-overlapping matches in text with leftmost-longest semantics
+    # Yields (start, end) spans in two passes, each linear in the length of text
+    # A right to left pass over the reversed NFA records, for every position, the
+    # states from which some match can still be completed by the text after it
+    # The left to right pass then starts each match at the first position whose
+    # start closure has such a state, and keeps only threads that can still
+    # complete one, so a match ends as soon as its threads die out and no
+    # character is read twice by the search for longer matches
+    def finditer(self, text):
+        closures = self.getEClosures()
+        startclosure = closures.get(self.startstate, frozenset([self.startstate]))
+        finalstates = set(self.finalstates)
+        symboltargets = self.symboltargets
+        classedges = self.classedges
+        viable = self.viablestates(text)
+        position = 0
+        while position <= len(text):
+            matchstart = position
+            while matchstart <= len(text) and startclosure.isdisjoint(viable[matchstart]):
+                matchstart += 1
+            if matchstart > len(text):
+                break
+            threads = startclosure & viable[matchstart]
+            matchend = matchstart if not threads.isdisjoint(finalstates) else None
+            i = matchstart
+            while i < len(text):
+                symbol = text[i]
+                next_threads = set()
+                for state in threads:
+                    targets = symboltargets.get((state, symbol))
+                    if targets:
+                        for target in targets:
+                            next_threads |= closures[target]
+                    if classedges and state in classedges:
+                        for charclass, target in classedges[state]:
+                            if symbol in charclass:
+                                next_threads |= closures[target]
+                i += 1
+                threads = next_threads & viable[i]
+                if not threads:
+                    break
+                if not threads.isdisjoint(finalstates):
+                    matchend = i
+            yield matchstart, matchend
+            position = matchend if matchend > matchstart else matchend + 1
+
+    # Return the list of frozensets, one per position of text and one past its
+    # end, of the states from which the rest of text starting there has a
+    # prefix taking the NFA to a final state
+    def viablestates(self, text):
+        closures = self.getEClosures()
+        # State -> states whose epsilon closure contains it
+        coclosures = {}
+        for state, closure in closures.items():
+            for closed in closure:
+                coclosures.setdefault(closed, set()).add(state)
+        sources = {}
+        for (state, symbol), targets in self.symboltargets.items():
+            for target in targets:
+                sources.setdefault((target, symbol), []).append(state)
+        classsources = {}
+        for state, edges in self.classedges.items():
+            for charclass, target in edges:
+                classsources.setdefault(target, []).append((charclass, state))
+        final = set()
+        for state in self.finalstates:
+            final |= coclosures.get(state, {state})
+        final = frozenset(final)
+        # (states after, symbol) -> states before, most texts repeat a few pairs
+        cache = {}
+        viable = [final] * (len(text) + 1)
+        current = final
+        for i in range(len(text) - 1, -1, -1):
+            symbol = text[i]
+            previous = cache.get((current, symbol))
+            if previous is None:
+                reached = set(final)
+                for state in current:
+                    for source in sources.get((state, symbol), ()):
+                        reached |= coclosures.get(source, {source})
+                    if classsources and state in classsources:
+                        for charclass, source in classsources[state]:
+                            if symbol in charclass:
+                                reached |= coclosures.get(source, {source})
+                previous = frozenset(reached)
+                if len(cache) < CLASSCACHESIZE:
+                    cache[(current, symbol)] = previous
+            viable[i] = previous
+            current = previous
+        return viable
+
+    # Return the span of the leftmost-longest match in text, or None
+    # Reads text only up to where the threads of the first match die out
+    def search(self, text):
+        closures = self.getEClosures()
+        startclosure = closures.get(self.startstate, frozenset([self.startstate]))
+        finalstates = set(self.finalstates)
+        symboltargets = self.symboltargets
+        classedges = self.classedges
+        threads = {}
+        matchstart = None
+        matchend = None
+        i = 0
+        while True:
+            if matchstart is None:
+                for state in startclosure:
+                    if state not in threads:
+                        threads[state] = i
+            for state, start in threads.items():
+                if state in finalstates and (matchstart is None or start <= matchstart):
+                    matchstart = start
+                    matchend = i
+            if matchstart is not None:
+                threads = {state: start for state, start in threads.items() if start <= matchstart}
+            if i == len(text) or not threads:
+                break
+            next_threads = {}
+            symbol = text[i]
+            for state, start in threads.items():
+                targets = symboltargets.get((state, symbol))
+                if state in classedges:
+                    targets = set(targets or ())
+                    for charclass, target in classedges[state]:
+                        if symbol in charclass:
+                            targets.add(target)
+                if targets:
+                    for target in targets:
+                        for closed in closures[target]:
+                            if closed not in next_threads or start < next_threads[closed]:
+                                next_threads[closed] = start
+            threads = next_threads
+            i += 1
+        if matchstart is None:
+            return None
+        return matchstart, matchend
+
+    # Same result as test_string, simulating the NFA on integer bitmasks
+    def test_string_bitset(self, input_string):
+        if self.bitsetsimulator is None:
+            self.bitsetsimulator = BitsetSimulator(self)
+        return self.bitsetsimulator.test_string(input_string)
 
     # Instantiate a semi-copy Automata object and return it
     def newBuildFromNumber(self, startnum):
@@ -138,6 +482,8 @@ class Automata:
         for fromstate, tostates in list(self.transitions.items()):
             for state in tostates:
                 rebuild.addtransition(translations[fromstate], translations[state], tostates[state])
+        if instrument.enabled:
+            self.countcopy("Automata.newBuildFromNumber")
         return [rebuild, startnum]
 
     # Instantiate a semi-copy Automata object using existing states and return it
@@ -151,6 +497,37 @@ class Automata:
             rebuild.addfinalstates(pos[s])
         return rebuild
 
+    # Instantiate a renumbered copy whose states are numbered breadth first
+    # from the starting state, so the starting state gets startnum
+    def newBuildFromStart(self, startnum):
+        translations = {self.startstate: startnum}
+        queue = [self.startstate]
+        for state in queue:
+            for tostate in self.transitions.get(state, {}):
+                if tostate not in translations:
+                    translations[tostate] = startnum + len(queue)
+                    queue.append(tostate)
+        for state in self.states:
+            if state not in translations:
+                translations[state] = startnum + len(translations)
+        rebuild = Automata(self.language)
+        rebuild.setstartstate(startnum)
+        for s in self.finalstates:
+            rebuild.addfinalstates(translations[s])
+        for fromstate, tostates in self.transitions.items():
+            for state in tostates:
+                rebuild.addtransition(translations[fromstate], translations[state], set(tostates[state]))
+        if instrument.enabled:
+            self.countcopy("Automata.newBuildFromStart")
+        return [rebuild, startnum + len(translations)]
+
+    # Record the states and transition labels copied by a renumbering copy
+    def countcopy(self, name):
+        instrument.count(name + ".calls")
+        instrument.count(name + ".states", len(self.states))
+        instrument.count(name + ".transitions", sum(
+            len(inputs) for tostates in self.transitions.values() for inputs in tostates.values()))
+
     def to_dot(self):
       dot_code = "digraph NFA {\n"
       dot_code += "    rankdir=LR;\n"
@@ -169,6 +546,782 @@ class Automata:
       dot_code += "}"
       return dot_code
 
+    # Return the code point intervals a transition symbol matches
+    @staticmethod
+    def symbolintervals(symbol):
+        if isinstance(symbol, CharClass):
+            return list(symbol.intervals)
+        if len(symbol) == 1:
+            return [(ord(symbol), ord(symbol))]
+        return []
+
+    # Partition the input alphabet into classes of characters that follow
+    # exactly the same transitions
+    def symbolclasses(self):
+        labels = set()
+        for tostates in self.transitions.values():
+            for inputs in tostates.values():
+                label = frozenset(inputs) - {Automata.epsilon()}
+                if label:
+                    labels.add(label)
+        labels = [[interval for symbol in label for interval in Automata.symbolintervals(symbol)]
+                  for label in labels]
+        return SymbolClasses.fromlabels(labels)
+
+    # Determinize with subset construction and return a DFA object
+    # With lazy=True the DFA states are only built when the input reaches them
+    # maxstates bounds the states a lazy DFA keeps, see DFA.flush
+    def to_dfa(self, lazy=False, maxstates=None):
+        return DFA(self, lazy or maxstates is not None, maxstates=maxstates)
+
+    # Return a compact read-only copy for matching, see FrozenAutomata
+    def freeze(self):
+        return FrozenAutomata(self)
+
+class FrozenAutomata:
+
+    __slots__ = ("language", "states", "startstate", "accepting", "symbolids", "classlabels",
+                 "offsets", "labels", "targets", "epsoffsets", "epstargets",
+                 "closureoffsets", "closuretargets", "cache")
+
+    # Read-only Automata constructor
+    # States are renumbered densely from 0 in sorted order, states maps a dense
+    # id back to the original number. Edges are stored CSR style: the symbol
+    # edges of state s are labels[k], targets[k] for k in offsets[s] to
+    # offsets[s + 1], epsilon edges and epsilon closures the same way in their
+    # own arrays. Transition symbols become integer label ids, accepting is a
+    # bitset with one bit per dense state
+    def __init__(self, nfa):
+        states = sorted(nfa.states)
+        ids = {state: i for i, state in enumerate(states)}
+        symbols = set()
+        for tostates in nfa.transitions.values():
+            for inputs in tostates.values():
+                symbols.update(inputs)
+        symbols.discard(Automata.epsilon())
+        plain = sorted(symbol for symbol in symbols if not isinstance(symbol, CharClass))
+        charclasses = sorted((symbol for symbol in symbols if isinstance(symbol, CharClass)),
+                             key=lambda charclass: charclass.intervals)
+        labelids = {symbol: i for i, symbol in enumerate(plain + charclasses)}
+        self.language = nfa.language
+        self.states = array('i', states)
+        self.startstate = ids[nfa.startstate]
+        self.accepting = 0
+        for state in nfa.finalstates:
+            self.accepting |= 1 << ids[state]
+        self.symbolids = {symbol: labelids[symbol] for symbol in plain}
+        self.classlabels = tuple((charclass, labelids[charclass]) for charclass in charclasses)
+
+        closures = nfa.getEClosures()
+        self.offsets = array('i', [0])
+        self.labels = array('i')
+        self.targets = array('i')
+        self.epsoffsets = array('i', [0])
+        self.epstargets = array('i')
+        self.closureoffsets = array('i', [0])
+        self.closuretargets = array('i')
+        for state in states:
+            edges = sorted((labelids[symbol], ids[tostate])
+                           for tostate, inputs in nfa.transitions.get(state, {}).items()
+                           for symbol in inputs if symbol != Automata.epsilon())
+            for label, target in edges:
+                self.labels.append(label)
+                self.targets.append(target)
+            self.offsets.append(len(self.labels))
+            self.epstargets.extend(sorted(ids[tostate] for tostate in nfa.epsilonedges.get(state, ())))
+            self.epsoffsets.append(len(self.epstargets))
+            self.closureoffsets.append(0)
+        # A closure only keeps the states that read a symbol or accept, the
+        # others never change the result of a match
+        important = {state for state in range(len(states))
+                     if self.offsets[state] < self.offsets[state + 1] or self.isfinal(state)}
+        for state in states:
+            self.closuretargets.extend(sorted(
+                ids[member] for member in closures.get(state, (state,)) if ids[member] in important))
+            self.closureoffsets[ids[state] + 1] = len(self.closuretargets)
+        self.cache = {}
+
+    # Return the label ids a character matches
+    def labelsfor(self, char):
+        found = self.cache.get(char)
+        if found is None:
+            found = {label for charclass, label in self.classlabels if char in charclass}
+            if char in self.symbolids:
+                found.add(self.symbolids[char])
+            found = frozenset(found)
+            if len(self.cache) < CLASSCACHESIZE:
+                self.cache[char] = found
+        return found
+
+    # Return the dense ids in the epsilon closure of a dense state that read a
+    # symbol or accept
+    def closure(self, state):
+        return self.closuretargets[self.closureoffsets[state]:self.closureoffsets[state + 1]]
+
+    # Is the dense state accepting
+    def isfinal(self, state):
+        return self.accepting >> state & 1 == 1
+
+    # Same result as Automata.test_string
+    # The edges of a state are sorted by label, so the edges of one label are
+    # found with two bisects
+    def test_string(self, input_string):
+        offsets = self.offsets
+        labels = self.labels
+        targets = self.targets
+        closureoffsets = self.closureoffsets
+        closuretargets = self.closuretargets
+        current = set(self.closure(self.startstate))
+        for char in input_string:
+            matching = self.labelsfor(char)
+            if not matching:
+                return False
+            next_states = set()
+            for state in current:
+                low = offsets[state]
+                high = offsets[state + 1]
+                if low == high:
+                    continue
+                for label in matching:
+                    k = bisect_left(labels, label, low, high)
+                    if k < high and labels[k] == label:
+                        next_states.update(targets[k:bisect_right(labels, label, k, high)])
+            current = set()
+            for state in next_states:
+                current.update(closuretargets[closureoffsets[state]:closureoffsets[state + 1]])
+            if not current:
+                return False
+        accepting = self.accepting
+        return any(accepting >> state & 1 for state in current)
+
+    # Test every string of an iterable, yielding (string, result) pairs
+    def match_many(self, strings):
+        for string in strings:
+            yield string, self.test_string(string)
+
+    # Return a mutable Automata with the original state numbers
+    def thaw(self):
+        symbols = {label: symbol for symbol, label in self.symbolids.items()}
+        symbols.update((label, charclass) for charclass, label in self.classlabels)
+        rebuild = Automata(self.language)
+        rebuild.setstartstate(self.states[self.startstate])
+        for state in range(len(self.states)):
+            rebuild.states.add(self.states[state])
+            if self.isfinal(state):
+                rebuild.addfinalstates(self.states[state])
+            for k in range(self.offsets[state], self.offsets[state + 1]):
+                rebuild.addtransition(self.states[state], self.states[self.targets[k]], symbols[self.labels[k]])
+            for k in range(self.epsoffsets[state], self.epsoffsets[state + 1]):
+                rebuild.addtransition(self.states[state], self.states[self.epstargets[k]], Automata.epsilon())
+        return rebuild
+
+    # Return the bytes held by the state, edge and closure arrays
+    def nbytes(self):
+        arrays = (self.states, self.offsets, self.labels, self.targets, self.epsoffsets,
+                  self.epstargets, self.closureoffsets, self.closuretargets)
+        return sum(len(values) * values.itemsize for values in arrays)
+
+class BitsetSimulator:
+
+    # Bit-parallel NFA simulator constructor
+    # Every NFA state gets one bit, so a set of active states is a single int
+    # Successor masks already include the epsilon closure of their targets
+    def __init__(self, nfa):
+        closures = nfa.getEClosures()
+        states = sorted(nfa.states)
+        self.states = states
+        self.bits = {state: i for i, state in enumerate(states)}
+        self.nbytes = (len(states) + 7) // 8
+        self.startmask = self.tomask(closures.get(nfa.startstate, [nfa.startstate]))
+        self.finalmask = self.tomask(nfa.finalstates)
+        self.successors = {}
+        for (state, symbol), targets in nfa.symboltargets.items():
+            masks = self.successors.setdefault(symbol, [0] * len(states))
+            for target in targets:
+                masks[self.bits[state]] |= self.tomask(closures[target])
+        # Character class edges are resolved the first time a character is read
+        self.classmasks = []
+        for state, edges in nfa.classedges.items():
+            for charclass, target in edges:
+                self.classmasks.append((charclass, self.bits[state], self.tomask(closures[target])))
+        for charclass, bit, mask in self.classmasks:
+            for symbol, masks in self.successors.items():
+                if symbol in charclass:
+                    masks[bit] |= mask
+        # Per symbol, one lazily filled 256 entry table for each byte of the mask
+        self.tables = {symbol: [None] * self.nbytes for symbol in self.successors}
+
+    # Convert an iterable of NFA states to a bitmask
+    def tomask(self, states):
+        mask = 0
+        for state in states:
+            mask |= 1 << self.bits[state]
+        return mask
+
+    # Add the successor masks of a character only matched by character classes
+    # Returns its tables, or an empty list if no state has a transition on it
+    def addsymbol(self, symbol):
+        masks = [0] * len(self.bits)
+        for charclass, bit, mask in self.classmasks:
+            if symbol in charclass:
+                masks[bit] |= mask
+        if not any(masks):
+            tables = []
+        else:
+            self.successors[symbol] = masks
+            tables = [None] * self.nbytes
+        self.tables[symbol] = tables
+        return tables
+
+    # Build the table mapping each value of one byte of the mask to the union
+    # of the successor masks of the states whose bits are set in it
+    def buildtable(self, symbol, chunk):
+        masks = self.successors[symbol][chunk * 8:chunk * 8 + 8]
+        masks.extend([0] * (8 - len(masks)))
+        table = [0] * 256
+        for value in range(1, 256):
+            lowest = value & -value
+            table[value] = table[value ^ lowest] | masks[lowest.bit_length() - 1]
+        self.tables[symbol][chunk] = table
+        return table
+
+    # Return the NFA states set in a bitmask
+    def tostates(self, mask):
+        states = self.states
+        return [states[bit] for bit in range(mask.bit_length()) if mask >> bit & 1]
+
+    # Return the mask of states reached from current after reading input_string
+    def run(self, input_string, current):
+        nbytes = self.nbytes
+        for symbol in input_string:
+            tables = self.tables.get(symbol)
+            if tables is None:
+                if not self.classmasks:
+                    return 0
+                tables = self.addsymbol(symbol)
+            if not tables:
+                return 0
+            next_mask = 0
+            for chunk, value in enumerate(current.to_bytes(nbytes, "little")):
+                if value:
+                    table = tables[chunk]
+                    if table is None:
+                        table = self.buildtable(symbol, chunk)
+                    next_mask |= table[value]
+            if not next_mask:
+                return 0
+            current = next_mask
+        return current
+
+    def test_string(self, input_string):
+        return bool(self.run(input_string, self.startmask) & self.finalmask)
+
+class SymbolClasses:
+
+    # Character class map constructor
+    # The code point line is cut into segments starting at the sorted
+    # boundaries and every segment is mapped to a class id
+    # Adjacent segments of the same class are merged
+    def __init__(self, boundaries, segmentclasses):
+        self.boundaries = []
+        self.segmentclasses = []
+        for boundary, cls in zip(boundaries, segmentclasses):
+            if self.segmentclasses and self.segmentclasses[-1] == cls:
+                continue
+            self.boundaries.append(boundary)
+            self.segmentclasses.append(cls)
+        self.count = max(self.segmentclasses) + 1
+        self.representatives = [None] * self.count
+        for boundary, cls in zip(self.boundaries, self.segmentclasses):
+            if self.representatives[cls] is None:
+                self.representatives[cls] = chr(boundary)
+        self.cache = {}
+
+    # Partition all characters given the labels of an automaton
+    # Each label is a list of inclusive (low, high) code point intervals and
+    # two characters share a class when they belong to exactly the same labels
+    @staticmethod
+    def fromlabels(labels):
+        points = {0}
+        for intervals in labels:
+            for low, high in intervals:
+                points.add(low)
+                if high < MAXCODEPOINT:
+                    points.add(high + 1)
+        boundaries = sorted(points)
+        signatures = [[] for _ in boundaries]
+        for label, intervals in enumerate(labels):
+            for low, high in intervals:
+                for segment in range(bisect_left(boundaries, low), bisect_right(boundaries, high)):
+                    signatures[segment].append(label)
+        classids = {}
+        segmentclasses = [classids.setdefault(tuple(signature), len(classids)) for signature in signatures]
+        return SymbolClasses(boundaries, segmentclasses)
+
+    # Return the class of a character, remembering it for the next lookup
+    def classify(self, char):
+        cls = self.segmentclasses[bisect_right(self.boundaries, ord(char)) - 1]
+        if len(self.cache) < CLASSCACHESIZE:
+            self.cache[char] = cls
+        return cls
+
+    # Return a new map where class c becomes class remap[c]
+    def merged(self, remap):
+        return SymbolClasses(self.boundaries, [remap[cls] for cls in self.segmentclasses])
+
+class DFA:
+
+    # DFA Constructor
+    # Each DFA state is the epsilon-closed set of NFA states it stands for
+    # Input characters are first mapped to classes of characters that no
+    # transition tells apart, so the table only has one column per class
+    # Row s, column c of the table is stored at s * width + c, with -1 for
+    # the dead state and None for transitions a lazy DFA has not built yet
+    # A lazy DFA with maxstates keeps at most that many states, flushing its
+    # cache when full; hits, misses, flushes and fallbacks count table
+    # lookups, built transitions, flushes and strings finished on the NFA
+    def __init__(self, nfa=None, lazy=False, classes=None, maxstates=None):
+        self.nfa = nfa
+        self.lazy = lazy
+        self.maxstates = maxstates
+        self.startstate = 0
+        self.finalstates = set()
+        self.table = []
+        self.subsets = []
+        self.subsetids = {}
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+        self.fallbacks = 0
+        if nfa is None:
+            self.classes = classes
+            self.width = classes.count
+            return
+        self.classes = nfa.symbolclasses()
+        self.width = self.classes.count
+        self.startsubset = frozenset(nfa.getEClose(nfa.startstate))
+        self.addsubset(self.startsubset)
+        if not lazy:
+            self.build()
+
+    # Register a set of NFA states as a DFA state and return its id
+    def addsubset(self, subset):
+        if subset in self.subsetids:
+            return self.subsetids[subset]
+        state = len(self.subsets)
+        self.subsetids[subset] = state
+        self.subsets.append(subset)
+        self.table.extend([None] * self.width)
+        for final_state in self.nfa.finalstates:
+            if final_state in subset:
+                self.finalstates.add(state)
+                break
+        return state
+
+    # Compute, store and return the transition of a DFA state on a class
+    def expand(self, state, cls):
+        next_states = set()
+        closures = self.nfa.getEClosures()
+        for nfastate in self.nfa.gettransitions(self.subsets[state], self.classes.representatives[cls]):
+            next_states |= closures[nfastate]
+        self.misses += 1
+        if not next_states:
+            target = -1
+        else:
+            subset = frozenset(next_states)
+            if subset not in self.subsetids and self.maxstates is not None and len(self.subsets) >= self.maxstates:
+                # The source state is evicted too, so the transition is not stored
+                self.flush()
+                return self.addsubset(subset)
+            target = self.addsubset(subset)
+        self.table[state * self.width + cls] = target
+        return target
+
+    # Drop every cached state except the starting state
+    # Lists are cleared in place so loops holding them stay valid
+    def flush(self):
+        self.flushes += 1
+        del self.table[:]
+        del self.subsets[:]
+        self.subsetids.clear()
+        self.finalstates.clear()
+        self.addsubset(self.startsubset)
+
+    # Continue a string on the NFA from a DFA state and return the DFA state
+    # of the set of NFA states reached, -1 if it is dead
+    def runnfa(self, state, input_string):
+        self.fallbacks += 1
+        nfa = self.nfa
+        if nfa.bitsetsimulator is None:
+            nfa.bitsetsimulator = BitsetSimulator(nfa)
+        simulator = nfa.bitsetsimulator
+        mask = simulator.run(input_string, simulator.tomask(self.subsets[state]))
+        if not mask:
+            return -1
+        subset = frozenset(simulator.tostates(mask))
+        if subset not in self.subsetids and len(self.subsets) >= self.maxstates:
+            self.flush()
+        return self.addsubset(subset)
+
+    # Return the cache counters
+    def info(self):
+        return {"states": len(self.subsets), "maxstates": self.maxstates, "hits": self.hits,
+                "misses": self.misses, "flushes": self.flushes, "fallbacks": self.fallbacks}
+
+    # Return the transition of a state on a class, building it if needed
+    def step(self, state, cls):
+        target = self.table[state * self.width + cls]
+        if target is None:
+            target = self.expand(state, cls)
+        return target
+
+    # Run subset construction until no new DFA states are found
+    # A complete DFA is never flushed, so any state bound is lifted
+    def build(self):
+        self.maxstates = None
+        position = 0
+        while position < len(self.table):
+            if self.table[position] is None:
+                self.expand(position // self.width, position % self.width)
+            position += 1
+        self.lazy = False
+        self.compressclasses()
+
+    # Merge classes whose columns are identical in the complete table
+    def compressclasses(self):
+        width = self.width
+        columns = {}
+        remap = []
+        for cls in range(width):
+            remap.append(columns.setdefault(tuple(self.table[cls::width]), len(columns)))
+        if len(columns) == width:
+            return
+        newwidth = len(columns)
+        table = [-1] * (len(self.subsets) * newwidth)
+        for cls in range(width):
+            table[remap[cls]::newwidth] = self.table[cls::width]
+        self.table = table
+        self.width = newwidth
+        self.classes = self.classes.merged(remap)
+
+    # Return the state reached after reading input_string, -1 if it is dead
+    # If the state cache keeps being flushed, the rest of the string is
+    # simulated on the NFA instead
+    def run(self, input_string):
+        table = self.table
+        width = self.width
+        cache = self.classes.cache
+        classify = self.classes.classify
+        state = self.startstate
+        misses = 0
+        lastflush = 0
+        thrash = 0
+        position = 0
+        for position, symbol in enumerate(input_string, 1):
+            cls = cache.get(symbol)
+            if cls is None:
+                cls = classify(symbol)
+            next_state = table[state * width + cls]
+            if next_state is None:
+                misses += 1
+                flushes = self.flushes
+                next_state = self.expand(state, cls)
+                if self.flushes != flushes:
+                    if position - lastflush < self.maxstates * THRASHRATIO:
+                        thrash += 1
+                    else:
+                        thrash = 0
+                    lastflush = position
+                    if thrash >= THRASHLIMIT and next_state >= 0:
+                        self.hits += position - misses
+                        return self.runnfa(next_state, input_string[position:])
+            if next_state < 0:
+                self.hits += position - misses
+                return -1
+            state = next_state
+        self.hits += position - misses
+        return state
+
+    def test_string(self, input_string):
+        return self.run(input_string) in self.finalstates
+
+    # Test every string of an iterable, yielding (string, result) pairs
+    def match_many(self, strings):
+        for string in strings:
+            yield string, self.test_string(string)
+
+    # Return the minimal equivalent DFA using Hopcroft's partition refinement
+    # States are renumbered canonically: breadth first from the start state,
+    # following classes in order, with the dead state left implicit
+    def minimize(self):
+        if self.lazy:
+            self.build()
+        width = self.width
+        dead = len(self.subsets)
+
+        # Inverse transitions, with the dead state made explicit
+        inverse = [{} for _ in range(width)]
+        for state in range(dead + 1):
+            for cls in range(width):
+                target = self.table[state * width + cls] if state != dead else dead
+                if target < 0:
+                    target = dead
+                inverse[cls].setdefault(target, []).append(state)
+
+        finals = set(self.finalstates)
+        others = set(range(dead + 1)) - finals
+        blocks = [block for block in (finals, others) if block]
+        blockof = {}
+        for i, block in enumerate(blocks):
+            for state in block:
+                blockof[state] = i
+        waiting = {min(range(len(blocks)), key=lambda i: len(blocks[i]))}
+
+        while waiting:
+            splitter = list(blocks[waiting.pop()])
+            for cls in range(width):
+                predecessors = {}
+                for target in splitter:
+                    for state in inverse[cls].get(target, ()):
+                        predecessors.setdefault(blockof[state], set()).add(state)
+                for i, inside in predecessors.items():
+                    if len(inside) == len(blocks[i]):
+                        continue
+                    outside = blocks[i] - inside
+                    blocks[i] = inside
+                    blocks.append(outside)
+                    new = len(blocks) - 1
+                    for state in outside:
+                        blockof[state] = new
+                    if i in waiting or len(outside) <= len(inside):
+                        waiting.add(new)
+                    else:
+                        waiting.add(i)
+
+        # Canonical numbering of the live blocks
+        deadblock = blockof[dead]
+        order = {blockof[self.startstate]: 0}
+        queue = [blockof[self.startstate]]
+        minimal = DFA(classes=self.classes)
+        minimal.nfa = self.nfa
+        for block in queue:
+            state = order[block]
+            representative = next(iter(blocks[block]))
+            if representative in finals:
+                minimal.finalstates.add(state)
+            members = [member for member in blocks[block] if member != dead]
+            minimal.subsets.append(frozenset().union(*[self.subsets[member] for member in members]))
+            minimal.table.extend([-1] * width)
+            for cls in range(width):
+                target = self.table[representative * width + cls] if representative != dead else -1
+                if target < 0 or blockof[target] == deadblock:
+                    continue
+                target = blockof[target]
+                if target not in order:
+                    order[target] = len(queue)
+                    queue.append(target)
+                minimal.table[state * width + cls] = order[target]
+        minimal.subsetids = {subset: state for state, subset in enumerate(minimal.subsets)}
+        minimal.compressclasses()
+        return minimal
+
+    # Check if two DFAs accept the same language
+    # Walks the product of both automata over the classes of their combined
+    # partition and fails on the first pair of states that disagree
+    # Lazy operands are built first, since a flush would renumber their states
+    def equivalent(self, other):
+        for dfa in (self, other):
+            if dfa.lazy:
+                dfa.build()
+        boundaries = set(self.classes.boundaries) | set(other.classes.boundaries)
+        pairs = {(self.classes.classify(chr(point)), other.classes.classify(chr(point))) for point in boundaries}
+        seen = {(self.startstate, other.startstate)}
+        queue = list(seen)
+        for state, otherstate in queue:
+            if (state in self.finalstates) != (otherstate in other.finalstates):
+                return False
+            for cls, othercls in pairs:
+                pair = (self.step(state, cls) if state >= 0 else -1,
+                        other.step(otherstate, othercls) if otherstate >= 0 else -1)
+                if pair not in seen:
+                    seen.add(pair)
+                    queue.append(pair)
+        return True
+
+    # Return a compact, picklable copy of the complete transition table
+    def totable(self):
+        if self.lazy:
+            self.build()
+        accepting = bytes(state in self.finalstates for state in range(len(self.subsets)))
+        return DFATable(self.classes, self.width, self.startstate, array('i', self.table), accepting)
+
+class DFATable:
+
+    # Flat transition table constructor
+    # Same layout as the DFA table, without the NFA state sets
+    # table and accepting may be any integer sequences, such as memoryviews
+    # over a mapped file; path is set when the table comes from such a file
+    def __init__(self, classes, width, startstate, table, accepting, path=None):
+        self.classes = classes
+        self.width = width
+        self.startstate = startstate
+        self.table = table
+        self.accepting = accepting
+        self.path = path
+        self.numpytable = None
+
+    # Tables loaded from a file are pickled as their path, so worker
+    # processes map the same file instead of receiving a copy
+    def __reduce__(self):
+        if self.path is not None:
+            return (load_automaton, (self.path,))
+        return (DFATable, (self.classes, self.width, self.startstate,
+                           array('i', self.table), bytes(self.accepting)))
+
+    def test_string(self, input_string):
+        table = self.table
+        width = self.width
+        cache = self.classes.cache
+        classify = self.classes.classify
+        state = self.startstate
+        for symbol in input_string:
+            cls = cache.get(symbol)
+            if cls is None:
+                cls = classify(symbol)
+            state = table[state * width + cls]
+            if state < 0:
+                return False
+        return self.accepting[state] == 1
+
+    # Test every string of an iterable, yielding (string, result) pairs
+    def match_many(self, strings):
+        for string in strings:
+            yield string, self.test_string(string)
+
+    # Test a batch of strings, returning a list of results in the same order
+    # With NumPy the table becomes a 2-D int32 array and all strings of a
+    # batch advance together, one fancy-indexing step per character position
+    # Without NumPy every string goes through test_string
+    def match_batch(self, strings):
+        strings = list(strings)
+        if numpy is None:
+            return [self.test_string(string) for string in strings]
+        if self.numpytable is None:
+            self.numpytable = self.buildnumpytable()
+        # Batches of similar lengths keep the padding small
+        lengths = numpy.fromiter(map(len, strings), dtype=numpy.int64, count=len(strings))
+        order = numpy.argsort(lengths, kind="stable")
+        results = numpy.zeros(len(strings), dtype=bool)
+        for first in range(0, len(strings), BATCHSIZE):
+            indexes = order[first:first + BATCHSIZE]
+            results[indexes] = self.matchnumpy([strings[i] for i in indexes.tolist()], lengths[indexes])
+        return results.tolist()
+
+    # Build the NumPy form of the table and class map
+    # Adds an explicit dead state and a padding class that keeps every state
+    # unchanged, so strings shorter than the batch simply stop moving
+    def buildnumpytable(self):
+        nstates = len(self.accepting)
+        dead = nstates
+        table = numpy.empty((nstates + 1, self.width + 1), dtype=numpy.int32)
+        body = numpy.asarray(self.table, dtype=numpy.int32).reshape(nstates, self.width)
+        table[:nstates, :self.width] = numpy.where(body < 0, dead, body)
+        table[dead, :] = dead
+        table[:, self.width] = numpy.arange(nstates + 1, dtype=numpy.int32)
+        accepting = numpy.zeros(nstates + 1, dtype=bool)
+        accepting[:nstates] = numpy.frombuffer(bytes(self.accepting), dtype=numpy.uint8) == 1
+        boundaries = numpy.array(self.classes.boundaries, dtype=numpy.uint32)
+        segmentclasses = numpy.array(self.classes.segmentclasses, dtype=numpy.int32)
+        return table, accepting, boundaries, segmentclasses
+
+    # Run one batch of strings through the NumPy table
+    def matchnumpy(self, strings, lengths):
+        table, accepting, boundaries, segmentclasses = self.numpytable
+        maxlength = int(lengths.max()) if len(strings) else 0
+        codes = numpy.full((maxlength, len(strings)), self.width, dtype=numpy.int32)
+        total = int(lengths.sum())
+        if total:
+            points = numpy.frombuffer("".join(strings).encode("utf-32-le", "surrogatepass"), dtype=numpy.uint32)
+            classes = segmentclasses[numpy.searchsorted(boundaries, points, side="right") - 1]
+            rows = numpy.repeat(numpy.arange(len(strings)), lengths)
+            starts = numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+            codes[numpy.arange(total) - starts, rows] = classes
+        states = numpy.full(len(strings), self.startstate, dtype=numpy.int32)
+        for position in range(maxlength):
+            states = table[states, codes[position]]
+        return accepting[states]
+
+# Test a batch of strings against an Automata, DFA or DFATable
+def match_batch(automaton, strings):
+    if isinstance(automaton, Automata):
+        automaton = automaton.to_dfa()
+    if isinstance(automaton, DFA):
+        automaton = automaton.totable()
+    return automaton.match_batch(strings)
+
+# Save an automaton in the versioned binary format read by load_automaton
+# Layout, little endian: a header (magic, version, reserved, start state,
+# number of states, number of classes, number of class map segments), the
+# segment boundaries and their classes as int32, one accepting byte per
+# state padded to 4 bytes, then the transition table as int32
+def save_automaton(automaton, path):
+    if isinstance(automaton, Automata):
+        automaton = automaton.to_dfa()
+    if isinstance(automaton, DFA):
+        automaton = automaton.totable()
+    classes = automaton.classes
+    nstates = len(automaton.accepting)
+    header = FORMATHEADER.pack(FORMATMAGIC, FORMATVERSION, 0, automaton.startstate, nstates,
+                               automaton.width, len(classes.boundaries))
+    padding = b"\0" * (-nstates % 4)
+    arrays = [array('i', classes.boundaries), array('i', classes.segmentclasses), array('i', automaton.table)]
+    if sys.byteorder != "little":
+        for values in arrays:
+            values.byteswap()
+    with open(path, "wb") as outfile:
+        outfile.write(header)
+        outfile.write(arrays[0].tobytes())
+        outfile.write(arrays[1].tobytes())
+        outfile.write(bytes(automaton.accepting) + padding)
+        outfile.write(arrays[2].tobytes())
+
+# Load an automaton written by save_automaton as a DFATable
+# With use_mmap the file is mapped read-only and the transition table is a
+# zero-copy view on it, shared with every process mapping the same file
+def load_automaton(path, use_mmap=True):
+    with open(path, "rb") as infile:
+        if use_mmap:
+            data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            data = infile.read()
+    if len(data) < FORMATHEADER.size:
+        raise ValueError("Not a saved automaton: {}".format(path))
+    magic, version, reserved, startstate, nstates, width, nsegments = FORMATHEADER.unpack_from(data)
+    if magic != FORMATMAGIC:
+        raise ValueError("Not a saved automaton: {}".format(path))
+    if version != FORMATVERSION:
+        raise ValueError("Unsupported automaton format version {}".format(version))
+    view = memoryview(data)
+    offset = FORMATHEADER.size
+    boundaries = array('i', view[offset:offset + 4 * nsegments].tobytes())
+    offset += 4 * nsegments
+    segmentclasses = array('i', view[offset:offset + 4 * nsegments].tobytes())
+    offset += 4 * nsegments
+    accepting = view[offset:offset + nstates]
+    offset += nstates + (-nstates % 4)
+    table = view[offset:offset + 4 * nstates * width]
+    if len(table) != 4 * nstates * width:
+        raise ValueError("Truncated automaton file: {}".format(path))
+    if sys.byteorder == "little":
+        table = table.cast('i')
+    else:
+        table = array('i', table.tobytes())
+        table.byteswap()
+        boundaries.byteswap()
+        segmentclasses.byteswap()
+    classes = SymbolClasses(list(boundaries), list(segmentclasses))
+    return DFATable(classes, width, startstate, table, accepting, path if use_mmap else None)
+
 class BuildAutomata:
 
     # Build basic automata part with 2 state
@@ -235,15 +1388,24 @@ class BuildAutomata:
 class NFAfromRegex:
 
     # NFA from Regex Parser constructor
-    def __init__(self, regex):
+    # With wildcard=True, '.' matches any character and concatenation is
+    # only implicit; otherwise '.' stays the explicit concatenation operator
+    def __init__(self, regex, wildcard=False):
         self.star = '*'
         self.positive_closure = '+'
+        self.optional = '?'
         self.union = '|'
         self.dot = '.'
         self.openingBracket = '('
         self.closingBracket = ')'
+        self.openingClass = '['
+        self.closingClass = ']'
+        self.negation = '^'
+        self.range = '-'
+        self.escape = '\\'
         self.operators = [self.union, self.dot]
         self.regex = regex
+        self.wildcard = wildcard
         self.alphabet = [chr(i) for i in range(65,91)]
         self.alphabet.extend([chr(i) for i in range(97,123)])
         self.alphabet.extend([chr(i) for i in range(48,58)])
@@ -257,22 +1419,46 @@ class NFAfromRegex:
     def displayNFA(self):
         self.nfa.display()
 
+    # Check if the previous regex character ends an operand, in which case a
+    # following operand is implicitly concatenated to it
+    def endsOperand(self, previous):
+        if previous == self.dot:
+            return self.wildcard
+        return previous in self.alphabet or previous in [self.closingBracket, self.closingClass,
+                                                         self.star, self.positive_closure, self.optional]
+
     # Main workspace for parsing and creating NFA from regex
     # Parse regex input
-    # Call build methods after processing and join the automatas
+    # Every state is added once to a single arena automaton and the operand
+    # stack only holds (start, end) fragments, so no sub-automaton is copied
+    # Character classes and the wildcard are one transition labelled with a
+    # CharClass, so the NFA grows with the pattern and not with the alphabet
     def buildNFA(self):
         language = set()
         self.stack = []
         self.automata = []
+        self.arena = Automata()
+        self.nextstate = 1
         previous = ":eps:"
-        for char in self.regex:
-            if char in self.alphabet:
-                language.add(char)
-                if previous != self.dot and (previous in self.alphabet or previous in [self.closingBracket, self.star, self.positive_closure]):
+        i = 0
+        while i < len(self.regex):
+            char = self.regex[i]
+            if char in self.alphabet or char == self.openingClass or (self.wildcard and char == self.dot):
+                if self.endsOperand(previous):
                     self.addOperatorToStack(self.dot)
-                self.automata.append(BuildAutomata.basicstruct(char))
+                if char == self.openingClass:
+                    label, i = self.parseClass(i)
+                    char = self.closingClass
+                elif char == self.dot:
+                    label = CharClass([], negated=True, text=self.dot)
+                else:
+                    label = char
+                language.add(label)
+                start, end = self.newstate(), self.newstate()
+                self.arena.addtransition(start, end, label)
+                self.automata.append((start, end))
             elif char == self.openingBracket:
-                if previous != self.dot and (previous in self.alphabet or previous in [self.closingBracket, self.star, self.positive_closure]):
+                if self.endsOperand(previous):
                     self.addOperatorToStack(self.dot)
                 self.stack.append(char)
             elif char == self.closingBracket:
@@ -282,20 +1468,71 @@ class NFAfromRegex:
                         break
                     elif o in self.operators:
                         self.processOperator(o)
-            elif char == self.star:
-                self.processOperator(char)
-            elif char == self.positive_closure:
+            elif char in [self.star, self.positive_closure, self.optional]:
                 self.processOperator(char)
             elif char in self.operators:
                 self.addOperatorToStack(char)
             previous = char
+            i += 1
 
         while len(self.stack) != 0:
             op = self.stack.pop()
             self.processOperator(op)
 
-        self.nfa = self.automata.pop()
-        self.nfa.language = language
+        start, end = self.automata.pop()
+        self.arena.setstartstate(start)
+        self.arena.addfinalstates(end)
+        self.arena.language = language
+        # Renumber once so the starting state is 1, as display expects
+        [self.nfa, m] = self.arena.newBuildFromStart(1)
+        del self.arena
+
+    # Parse the character class starting at position i of the regex
+    # Supports ranges like a-z, a leading ^ for negation and \ escapes
+    # Returns the transition label and the position of the closing ]
+    def parseClass(self, i):
+        start = i
+        i += 1
+        negated = False
+        if i < len(self.regex) and self.regex[i] == self.negation:
+            negated = True
+            i += 1
+        # (char, escaped) pairs, so an escaped range character stands for itself
+        chars = []
+        first = True
+        while i < len(self.regex) and (self.regex[i] != self.closingClass or first):
+            char = self.regex[i]
+            escaped = char == self.escape and i + 1 < len(self.regex)
+            if escaped:
+                i += 1
+                char = self.regex[i]
+            chars.append((char, escaped))
+            first = False
+            i += 1
+        if i >= len(self.regex):
+            raise ValueError("Unterminated character class in regex: {}".format(self.regex[start:]))
+        intervals = []
+        j = 0
+        while j < len(chars):
+            low = chars[j][0]
+            if j + 2 < len(chars) and chars[j + 1] == (self.range, False):
+                high = chars[j + 2][0]
+                if ord(low) > ord(high):
+                    raise ValueError("Invalid range in character class: {}-{}".format(low, high))
+                intervals.append((ord(low), ord(high)))
+                j += 3
+            else:
+                intervals.append((ord(low), ord(low)))
+                j += 1
+        if not negated and len(intervals) == 1 and intervals[0][0] == intervals[0][1]:
+            return chr(intervals[0][0]), i
+        return CharClass(intervals, negated, self.regex[start:i + 1]), i
+
+    # Allocate a new state number in the arena
+    def newstate(self):
+        state = self.nextstate
+        self.nextstate += 1
+        return state
 
     # Add to stack and check operator
     def addOperatorToStack(self, char):
@@ -312,23 +1549,272 @@ class NFAfromRegex:
                 break
         self.stack.append(char)
 
-    # Check which operator is given and build automata part for each case
+    # Check which operator is given and link fragments in the arena for each case
     def processOperator(self, operator):
+        eps = Automata.epsilon()
+        arena = self.arena
         if operator == self.star:
             a = self.automata.pop()
-            self.automata.append(BuildAutomata.starstruct(a))
+            start, end = self.newstate(), self.newstate()
+            arena.addtransition(start, a[0], eps)
+            arena.addtransition(start, end, eps)
+            arena.addtransition(a[1], end, eps)
+            arena.addtransition(a[1], a[0], eps)
+            self.automata.append((start, end))
         elif operator == self.positive_closure:
             a = self.automata.pop()
-            self.automata.append(BuildAutomata.dotstruct(a, BuildAutomata.starstruct(a)))
+            arena.addtransition(a[1], a[0], eps)
+            self.automata.append(a)
+        elif operator == self.optional:
+            a = self.automata.pop()
+            start, end = self.newstate(), self.newstate()
+            arena.addtransition(start, a[0], eps)
+            arena.addtransition(start, end, eps)
+            arena.addtransition(a[1], end, eps)
+            self.automata.append((start, end))
         elif operator in self.operators:
             a = self.automata.pop()
             b = self.automata.pop()
             if operator == self.union:
-                self.automata.append(BuildAutomata.unionstruct(b,a))
+                start, end = self.newstate(), self.newstate()
+                arena.addtransition(start, b[0], eps)
+                arena.addtransition(start, a[0], eps)
+                arena.addtransition(b[1], end, eps)
+                arena.addtransition(a[1], end, eps)
+                self.automata.append((start, end))
             elif operator == self.dot:
-                self.automata.append(BuildAutomata.dotstruct(b,a))
+                arena.addtransition(b[1], a[0], eps)
+                self.automata.append((b[0], a[1]))
 
-if __name__ == "__main__":
+class RegexSet:
+
+    # Multi-pattern matcher constructor
+    # All patterns are joined into one NFA under a new starting state 0 and
+    # each final state remembers the id (index) of the pattern it accepts
+    # maxstates bounds the lazy DFA used for matching, see DFA.flush
+    def __init__(self, patterns, wildcard=False, maxstates=None):
+        self.patterns = list(patterns)
+        self.nfa = Automata()
+        self.nfa.setstartstate(0)
+        self.patternids = {}
+        language = set()
+        offset = 1
+        for patternid, pattern in enumerate(self.patterns):
+            nfa = NFAfromRegex(pattern, wildcard).getNFA()
+            [nfa, m] = nfa.newBuildFromStart(offset)
+            self.nfa.addtransition(0, nfa.startstate, Automata.epsilon())
+            for fromstate, tostates in nfa.transitions.items():
+                for tostate, inputs in tostates.items():
+                    self.nfa.addtransition(fromstate, tostate, inputs)
+            for state in nfa.finalstates:
+                self.nfa.addfinalstates(state)
+                self.patternids.setdefault(state, set()).add(patternid)
+            language |= nfa.language
+            offset = m
+        self.nfa.language = language
+        self.dfa = self.nfa.to_dfa(lazy=True, maxstates=maxstates)
+        self.matchids = {}
+        self.flushes = 0
+
+    # Return the sorted ids of the patterns accepted in a DFA state
+    def stateids(self, state):
+        if self.dfa.flushes != self.flushes:
+            self.matchids.clear()
+            self.flushes = self.dfa.flushes
+        ids = self.matchids.get(state)
+        if ids is None:
+            ids = set()
+            for nfastate in self.dfa.subsets[state]:
+                if nfastate in self.patternids:
+                    ids |= self.patternids[nfastate]
+            ids = self.matchids[state] = tuple(sorted(ids))
+        return ids
+
+    # Return the ids of every pattern matching the whole string, in one pass
+    def match(self, input_string):
+        state = self.dfa.run(input_string)
+        if state < 0:
+            return ()
+        return self.stateids(state)
+
+    # Match every string of an iterable, yielding (string, ids) pairs
+    def match_many(self, strings):
+        for string in strings:
+            yield string, self.match(string)
+
+class RegexCache:
+
+    # Compiled regex cache constructor
+    # Least recently used patterns are dropped once maxsize is exceeded
+    # Cached automata are shared between callers and must not be modified
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Return the cache entry of a pattern, building its NFA on a miss
+    # Building happens outside the lock so slow patterns do not block others
+    def getentry(self, pattern, wildcard=False):
+        key = (pattern, wildcard)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        entry = {"nfa": NFAfromRegex(pattern, wildcard).getNFA(), "dfa": None}
+        with self.lock:
+            entry = self.entries.setdefault(key, entry)
+            self.entries.move_to_end(key)
+            self.trim()
+        return entry
+
+    # Return the NFA built from a pattern
+    def getNFA(self, pattern, wildcard=False):
+        return self.getentry(pattern, wildcard)["nfa"]
+
+    # Return the DFA of a pattern, building it once
+    # The DFA is fully constructed so it can be shared between threads
+    def getDFA(self, pattern, wildcard=False):
+        entry = self.getentry(pattern, wildcard)
+        if entry["dfa"] is None:
+            entry["dfa"] = entry["nfa"].to_dfa()
+        return entry["dfa"]
+
+    # Change the maximum number of cached patterns
+    def resize(self, maxsize):
+        with self.lock:
+            self.maxsize = maxsize
+            self.trim()
+
+    # Drop least recently used entries, the lock must be held
+    def trim(self):
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    # Return hit/miss statistics
+    def info(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": len(self.entries), "maxsize": self.maxsize}
+
+# Module level cache used by compile_regex and compile_dfa
+regex_cache = RegexCache()
+
+# Return the cached NFA of a pattern
+def compile_regex(pattern, wildcard=False):
+    return regex_cache.getNFA(pattern, wildcard)
+
+# Return the cached DFA of a pattern
+def compile_dfa(pattern, wildcard=False):
+    return regex_cache.getDFA(pattern, wildcard)
+
+# Match every line of a text stream against an automaton
+# Lines are read one at a time through a buffered reader, so memory stays
+# constant however large the input is
+# Writes "accept"/"reject" before each line, or only matching lines when
+# only_matching is set, and returns (lines read, lines matched)
+def match_stream(automaton, infile, outfile, only_matching=False):
+    lines = 0
+    matched = 0
+    for line, result in automaton.match_many(line.rstrip("\r\n") for line in infile):
+        lines += 1
+        if result:
+            matched += 1
+            if only_matching:
+                outfile.write(line + "\n")
+        if not only_matching:
+            outfile.write(("accept\t" if result else "reject\t") + line + "\n")
+    return lines, matched
+
+# Transition table of the automaton in a worker process of match_file_parallel
+_worker_table = None
+
+def _initworker(table):
+    global _worker_table
+    _worker_table = table
+
+# Match the lines of one byte range of a file in a worker process
+# Returns (lines read, lines matched, output text)
+def _matchrange(path, start, end, only_matching, encoding):
+    with open(path, "rb") as infile:
+        infile.seek(start)
+        data = infile.read(end - start)
+    text = data.decode(encoding, errors="replace").replace("\r\n", "\n").replace("\r", "\n")
+    if text.endswith("\n"):
+        text = text[:-1]
+    output = []
+    lines = 0
+    matched = 0
+    if data:
+        for line, result in _worker_table.match_many(text.split("\n")):
+            lines += 1
+            if result:
+                matched += 1
+                if only_matching:
+                    output.append(line + "\n")
+            if not only_matching:
+                output.append(("accept\t" if result else "reject\t") + line + "\n")
+    return lines, matched, "".join(output)
+
+# Split a file into byte ranges of about chunksize bytes ending on line breaks
+def _lineranges(path, chunksize):
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, "rb") as infile:
+        start = 0
+        while start < size:
+            infile.seek(min(start + chunksize, size))
+            if infile.tell() < size:
+                infile.readline()
+            end = infile.tell()
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+# Match every line of a file on a pool of worker processes
+# The file is split into line aligned byte ranges, the DFA table is sent to
+# each worker once, and results are written in input order
+# Returns (lines read, lines matched, lines per second)
+def match_file_parallel(automaton, path, outfile, only_matching=False, workers=None,
+                        chunksize=1 << 22, encoding="utf-8"):
+    if isinstance(automaton, Automata):
+        automaton = automaton.to_dfa()
+    if isinstance(automaton, DFA):
+        automaton = automaton.totable()
+    begin = time.perf_counter()
+    lines = 0
+    matched = 0
+    ranges = _lineranges(path, chunksize)
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers, initializer=_initworker, initargs=(automaton,)) as executor:
+        # At most two ranges per worker are in flight or waiting to be written,
+        # so memory does not grow with the file size
+        pending = deque()
+        nextrange = 0
+        while nextrange < len(ranges) or pending:
+            while nextrange < len(ranges) and len(pending) < 2 * workers:
+                start, end = ranges[nextrange]
+                pending.append(executor.submit(_matchrange, path, start, end, only_matching, encoding))
+                nextrange += 1
+            chunklines, chunkmatched, output = pending.popleft().result()
+            lines += chunklines
+            matched += chunkmatched
+            outfile.write(output)
+    elapsed = time.perf_counter() - begin
+    return lines, matched, lines / elapsed if elapsed > 0 else 0.0
+
+# Interactive mode: read a regex and test strings typed by the user
+def interactive():
     regex = input("Enter the regex: ")
     nfa_builder = NFAfromRegex(regex)
     nfa = nfa_builder.getNFA()
@@ -345,6 +1831,46 @@ if __name__ == "__main__":
         else:
             print(f"'{test_string}' is not valid for the regex '{regex}'.")
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Test strings against a regex. "
+                                     "Without arguments, starts the interactive mode.")
+    parser.add_argument("regex", nargs="?", help="regex every input line is matched against")
+    parser.add_argument("file", nargs="?", default="-", help="newline-delimited input file, - for stdin")
+    parser.add_argument("-g", "--grep", action="store_true", help="only print the matching lines")
+    parser.add_argument("-w", "--wildcard", action="store_true",
+                        help="treat . as any character instead of the concatenation operator")
+    parser.add_argument("--max-states", type=int, default=10000,
+                        help="states kept by the lazy DFA when matching on one process")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="match the file on this many processes")
+    parser.add_argument("--chunk-size", type=int, default=1 << 22,
+                        help="bytes of input per parallel task")
+    parser.add_argument("--stats", action="store_true",
+                        help="report lines read, matched and throughput on stderr")
+    args = parser.parse_args(argv)
 
+    if args.regex is None:
+        interactive()
+        return
 
+    begin = time.perf_counter()
+    if args.workers is not None and args.file != "-":
+        lines, matched, rate = match_file_parallel(compile_dfa(args.regex, args.wildcard), args.file, sys.stdout,
+                                                   args.grep, args.workers, args.chunk_size)
+    else:
+        # One lazily determinized automaton serves the whole stream
+        automaton = compile_regex(args.regex, args.wildcard).to_dfa(maxstates=args.max_states)
+        # Undecodable bytes are replaced as in match_file_parallel
+        if args.file == "-":
+            sys.stdin.reconfigure(errors="replace")
+            lines, matched = match_stream(automaton, sys.stdin, sys.stdout, args.grep)
+        else:
+            with open(args.file, buffering=1 << 20, encoding="utf-8", errors="replace") as infile:
+                lines, matched = match_stream(automaton, infile, sys.stdout, args.grep)
+        elapsed = time.perf_counter() - begin
+        rate = lines / elapsed if elapsed > 0 else 0.0
+    if args.stats:
+        print(f"{lines} lines, {matched} matched, {rate:.0f} lines/s", file=sys.stderr)
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+import itertools
+import random
+
+import pytest
+
+import instrument
+from cfg import ContextFreeGrammar
+
+NULL = "λ"
+MAXLENGTH = 5
+
+# Grammars as (variables, terminals, rules, start), rules as {variable: [bodies]}
+GRAMMARS = {
+    "nullable": ({"S", "A", "B"}, {"a", "b"},
+                 {"S": ["AB", "λ"], "A": ["aA", "λ"], "B": ["b", "bB", "λ"]}, "S"),
+    "cyclic": ({"S", "A", "B"}, {"a", "b"},
+               {"S": ["A", "aSb"], "A": ["S", "B", "a"], "B": ["A", "bb"]}, "S"),
+    "ambiguous": ({"E"}, {"+", "*", "a"}, {"E": ["E+E", "E*E", "a"]}, "E"),
+    "balanced": ({"S", "T"}, {"a", "b"}, {"S": ["aSb", "T", "λ"], "T": ["ab", "ba", "TT"]}, "S"),
+    "multichar": ({"Expr", "Term"}, {"+", "id"}, {"Expr": ["Expr+Term", "Term"], "Term": ["id"]}, "Expr"),
+    "unproductive": ({"S", "A", "U"}, {"a", "b"}, {"S": ["aA", "U"], "A": ["b", "AU"], "U": ["aU"]}, "S"),
+    "empty": ({"S", "A"}, {"a"}, {"S": ["AA", "λ"], "A": ["S"]}, "S"),
+}
+
+# Random grammars over S, A, B and a, b, with null, unit and cyclic rules
+def generate_grammar(seed):
+    rng = random.Random(seed)
+    variables = ["S", "A", "B"]
+    symbols = variables + ["a", "b"]
+    rules = {}
+    for variable in variables:
+        bodies = set()
+        for _ in range(rng.randint(1, 3)):
+            length = rng.choice([0, 1, 1, 2, 2, 3])
+            bodies.add("".join(rng.choice(symbols) for _ in range(length)) or NULL)
+        rules[variable] = sorted(bodies)
+    return set(variables), {"a", "b"}, rules, "S"
+
+for seed in range(40):
+    GRAMMARS["random{}".format(seed)] = generate_grammar(seed)
+
+def split_body(body, symbols):
+    if body == NULL:
+        return ()
+    parts = []
+    i = 0
+    while i < len(body):
+        symbol = next(symbol for symbol in symbols if body.startswith(symbol, i))
+        parts.append(symbol)
+        i += len(symbol)
+    return tuple(parts)
+
+# The sentences of up to MAXLENGTH terminals, as tuples of terminals, computed
+# as the least fixpoint of the rules so nullable and cyclic rules need no care
+def brute_force_language(variables, terminals, rules, start):
+    symbols = sorted(variables | terminals, key=len, reverse=True)
+    bodies = {variable: [split_body(body, symbols) for body in rules[variable]] for variable in variables}
+    language = {variable: set() for variable in variables}
+    changed = True
+    while changed:
+        changed = False
+        for variable in variables:
+            for body in bodies[variable]:
+                sentences = {()}
+                for symbol in body:
+                    options = language[symbol] if symbol in variables else {(symbol,)}
+                    sentences = {left + right for left in sentences for right in options
+                                 if len(left) + len(right) <= MAXLENGTH}
+                new = sentences - language[variable]
+                if new:
+                    language[variable] |= new
+                    changed = True
+    return language[start]
+
+def make_grammar(variables, terminals, rules, start):
+    return ContextFreeGrammar(set(variables), set(terminals) | {NULL}, dict(rules), start, NULL)
+
+# Every string of up to MAXLENGTH terminals, with the tuple of its terminals
+def sentences(terminals, minlength=0):
+    for length in range(minlength, MAXLENGTH + 1):
+        for sentence in itertools.product(sorted(terminals), repeat=length):
+            yield "".join(sentence), sentence
+
+def leaves(tree):
+    found = []
+    stack = [tree]
+    while stack:
+        tree = stack.pop()
+        if isinstance(tree, str):
+            found.append(tree)
+        else:
+            stack.extend(reversed(tree[1:]))
+    return found
+
+@pytest.mark.parametrize("name", sorted(GRAMMARS))
+def test_cyk_agrees_with_brute_force(name):
+    variables, terminals, rules, start = GRAMMARS[name]
+    language = brute_force_language(variables, terminals, rules, start)
+    grammar = make_grammar(variables, terminals, rules, start)
+    for string, sentence in sentences(terminals):
+        assert grammar.cyk_algorithm(string) == (sentence in language), string
+        assert (string in grammar.compile()) == (sentence in language), string
+
+@pytest.mark.parametrize("name", ["nullable", "cyclic", "balanced", "unproductive", "random3", "random7"])
+def test_simplify_keeps_language(name):
+    variables, terminals, rules, start = GRAMMARS[name]
+    language = brute_force_language(variables, terminals, rules, start)
+    grammar = make_grammar(variables, terminals, rules, start)
+    grammar.simplify()
+    for string, sentence in sentences(terminals, minlength=1):
+        assert grammar.cyk_algorithm(string) == (sentence in language), string
+
+def test_compile_is_cached():
+    grammar = make_grammar(*GRAMMARS["balanced"])
+    recognizer = grammar.compile()
+    assert grammar.compile() is recognizer
+    assert make_grammar(*GRAMMARS["balanced"]).compile() == recognizer
+    with pytest.raises(AttributeError):
+        recognizer._start = 0
+
+def test_compile_leaves_grammar_unchanged():
+    grammar = make_grammar(*GRAMMARS["cyclic"])
+    grammar.earley_algorithm("ab")
+    rules, variables = grammar.rules, grammar.variables
+    names, parser = list(grammar._symbol_names), grammar.earley_parser()
+    grammar.compile()
+    assert grammar.rules == rules and grammar.variables == variables
+    assert grammar._symbol_names == names
+    assert grammar.earley_parser() is parser
+
+@pytest.mark.parametrize("name", sorted(GRAMMARS))
+def test_earley_agrees_with_brute_force(name):
+    variables, terminals, rules, start = GRAMMARS[name]
+    language = brute_force_language(variables, terminals, rules, start)
+    grammar = make_grammar(variables, terminals, rules, start)
+    for string, sentence in sentences(terminals):
+        assert grammar.earley_algorithm(string) == (sentence in language), string
+
+@pytest.mark.parametrize("name", sorted(GRAMMARS))
+def test_parse_forest_trees(name):
+    variables, terminals, rules, start = GRAMMARS[name]
+    language = brute_force_language(variables, terminals, rules, start)
+    grammar = make_grammar(variables, terminals, rules, start)
+    for sentence in sorted(language, key=len)[:30]:
+        string = "".join(sentence)
+        forest = grammar.parse_forest(string)
+        assert forest is not None and forest.label == start
+        trees = list(itertools.islice(forest.trees(), 20))
+        assert trees
+        for tree in trees:
+            assert tree[0] == start
+            assert "".join(leaves(tree)) == string
+    assert grammar.parse_forest("b" * (MAXLENGTH + 1) + "c") is None
+
+def test_ambiguous_forest():
+    grammar = make_grammar(*GRAMMARS["ambiguous"])
+    forest = grammar.parse_forest("a+a*a")
+    assert forest.is_ambiguous()
+    assert set(forest.trees()) == {
+        ("E", ("E", ("E", "a"), "+", ("E", "a")), "*", ("E", "a")),
+        ("E", ("E", "a"), "+", ("E", ("E", "a"), "*", ("E", "a"))),
+    }
+    assert not grammar.parse_forest("a+a").is_ambiguous()
+
+def test_parse_forest_deep_input():
+    grammar = make_grammar({"E", "T", "F"}, {"+", "*", "(", ")", "a"},
+                           {"E": ["E+T", "T"], "T": ["T*F", "F"], "F": ["(E)", "a"]}, "E")
+    string = "(" * 1500 + "a+a*a" + ")" * 1500
+    forest = grammar.parse_forest(string)
+    assert not forest.is_ambiguous()
+    trees = list(forest.trees())
+    assert len(trees) == 1 and "".join(leaves(trees[0])) == string
+
+def test_right_recursion_is_linear():
+    grammar = make_grammar({"S"}, {"a"}, {"S": ["aS", "a"]}, "S")
+    for length in (1000, 4000):
+        with instrument.recording():
+            assert grammar.earley_algorithm("a" * length)
+        assert instrument.counters["EarleyParser.recognize.items"] <= 6 * length
+        forest = grammar.parse_forest("a" * length)
+        assert not forest.is_ambiguous()
+        assert leaves(next(forest.trees())) == ["a"] * length
+
+def test_trees_of_repeated_nullable_node():
+    grammar = make_grammar({"S", "A"}, {"a"}, {"S": ["AAa"], "A": ["a", NULL]}, "S")
+    assert list(grammar.parse_forest("a").trees()) == [("S", ("A",), ("A",), "a")]
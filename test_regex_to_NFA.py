@@ -0,0 +1,214 @@
+import io
+import random
+import re
+
+import pytest
+
+import instrument
+import regex_to_NFA
+from regex_to_NFA import (
+    NFAfromRegex,
+    RegexCache,
+    RegexSet,
+    compile_regex,
+    load_automaton,
+    main,
+    match_batch,
+    match_file_parallel,
+    match_stream,
+    save_automaton,
+)
+
+ATOMS = ["a", "b", "c", "[ab]", "[^a]", "[b-c]"]
+OPERATORS = "*+?"
+
+# Random regexes over a, b and c with classes, ranges and every operator, in the
+# syntax shared with re
+def generate_regex(rng, depth=0):
+    choice = rng.random()
+    if depth > 3 or choice < 0.3:
+        return rng.choice(ATOMS)
+    if choice < 0.45:
+        return "(" + generate_regex(rng, depth + 1) + ")" + rng.choice(OPERATORS)
+    if choice < 0.65:
+        return generate_regex(rng, depth + 1) + "|" + generate_regex(rng, depth + 1)
+    return generate_regex(rng, depth + 1) + generate_regex(rng, depth + 1)
+
+def generate_texts(rng, count=40, maxlength=8):
+    return ["".join(rng.choice("abcd") for _ in range(rng.randint(0, maxlength))) for _ in range(count)]
+
+def random_cases(count=150, seed=0):
+    rng = random.Random(seed)
+    return [(generate_regex(rng), generate_texts(rng)) for _ in range(count)]
+
+CASES = random_cases()
+
+@pytest.mark.parametrize("regex, texts", CASES)
+def test_test_string_matches_re(regex, texts):
+    nfa = NFAfromRegex(regex).getNFA()
+    pattern = re.compile(regex)
+    assert [nfa.test_string(text) for text in texts] == [pattern.fullmatch(text) is not None for text in texts]
+
+@pytest.mark.parametrize("regex, texts", CASES)
+def test_engines_agree_with_test_string(regex, texts):
+    nfa = NFAfromRegex(regex).getNFA()
+    expected = [nfa.test_string(text) for text in texts]
+    dfa = nfa.to_dfa()
+    minimal = dfa.minimize()
+    frozen = nfa.freeze()
+    engines = {
+        "dfa": dfa.test_string,
+        "lazy": nfa.to_dfa(lazy=True).test_string,
+        "minimal": minimal.test_string,
+        "bitset": nfa.test_string_bitset,
+        "table": minimal.totable().test_string,
+        "bounded": nfa.to_dfa(lazy=True, maxstates=2).test_string,
+        "frozen": frozen.test_string,
+        "thawed": frozen.thaw().test_string,
+    }
+    for name, matcher in engines.items():
+        assert [matcher(text) for text in texts] == expected, name
+    assert match_batch(nfa, texts) == expected
+    assert minimal.equivalent(dfa)
+
+def test_minimize_is_canonical():
+    first = NFAfromRegex("(a|b)*abb").getNFA().to_dfa().minimize()
+    second = NFAfromRegex("(a|b)*(ab)b").getNFA().to_dfa().minimize()
+    assert first.equivalent(second)
+    assert len(first.subsets) == len(second.subsets) == 4
+    assert first.finalstates == second.finalstates
+    assert not first.equivalent(NFAfromRegex("(a|b)*ab").getNFA().to_dfa().minimize())
+
+def test_addfinalstates_resets_bitset():
+    nfa = NFAfromRegex("a").getNFA()
+    state = max(nfa.states) + 1
+    nfa.addtransition(nfa.startstate, state, "b")
+    assert not nfa.test_string_bitset("b")
+    nfa.addfinalstates(state)
+    assert nfa.test_string("b") and nfa.test_string_bitset("b")
+
+def test_regex_cache():
+    cache = RegexCache(maxsize=2)
+    first = cache.getNFA("ab*")
+    assert cache.getNFA("ab*") is first
+    cache.getNFA("a|b")
+    cache.getNFA("c")
+    assert cache.getNFA("ab*") is not first
+    assert cache.info() == {"hits": 1, "misses": 4, "size": 2, "maxsize": 2}
+    assert cache.getDFA("c") is cache.getDFA("c")
+
+def test_match_stream():
+    outfile = io.StringIO()
+    assert match_stream(compile_regex("ab*"), io.StringIO("ab\nb\nabbb\n"), outfile) == (3, 2)
+    assert outfile.getvalue() == "accept\tab\nreject\tb\naccept\tabbb\n"
+    outfile = io.StringIO()
+    match_stream(compile_regex("ab*"), io.StringIO("ab\nb\nabbb\n"), outfile, only_matching=True)
+    assert outfile.getvalue() == "ab\nabbb\n"
+
+def test_main_replaces_undecodable_bytes(tmp_path, capsys):
+    path = tmp_path / "input.txt"
+    path.write_bytes(b"ab\n\xff\xfeab\nabb\r\nc\n")
+    expected = "accept\tab\nreject\t��ab\naccept\tabb\nreject\tc\n"
+    main(["ab*", str(path)])
+    assert capsys.readouterr().out == expected
+    main(["ab*", str(path), "-j", "2"])
+    assert capsys.readouterr().out == expected
+
+def test_match_file_parallel(tmp_path):
+    lines = generate_texts(random.Random(2), count=2000)
+    path = tmp_path / "input.txt"
+    path.write_text("\n".join(lines) + "\n")
+    expected = io.StringIO()
+    match_stream(compile_regex("a(b|c)*"), io.StringIO("\n".join(lines) + "\n"), expected)
+    output = io.StringIO()
+    result = match_file_parallel(compile_regex("a(b|c)*"), str(path), output, workers=2, chunksize=512)
+    assert output.getvalue() == expected.getvalue()
+    assert result[:2] == (len(lines), expected.getvalue().count("accept\t"))
+
+@pytest.mark.parametrize("regex, texts", CASES[:40])
+def test_instrumented_test_string(regex, texts):
+    nfa = NFAfromRegex(regex).getNFA()
+    expected = [nfa.test_string(text) for text in texts]
+    with instrument.recording():
+        assert [nfa.test_string(text) for text in texts] == expected
+    assert instrument.counters["Automata.test_string.calls"] == len(texts)
+
+# Leftmost-longest non-overlapping spans, found by testing every substring
+def brute_force_spans(nfa, text):
+    spans = []
+    position = 0
+    while position <= len(text):
+        for start in range(position, len(text) + 1):
+            ends = [end for end in range(start, len(text) + 1) if nfa.test_string(text[start:end])]
+            if ends:
+                break
+        else:
+            break
+        spans.append((start, ends[-1]))
+        position = ends[-1] if ends[-1] > start else ends[-1] + 1
+    return spans
+
+@pytest.mark.parametrize("regex, texts", CASES[:60])
+def test_finditer(regex, texts):
+    nfa = NFAfromRegex(regex).getNFA()
+    for text in texts + ["abcdabcdcbadcba"]:
+        spans = brute_force_spans(nfa, text)
+        assert list(nfa.finditer(text)) == spans
+        assert nfa.search(text) == (spans[0] if spans else None)
+
+def test_finditer_long_run():
+    nfa = NFAfromRegex("b|b(b)*c").getNFA()
+    assert list(nfa.finditer("b" * 5000)) == [(i, i + 1) for i in range(5000)]
+
+def test_regexset_ids():
+    rng = random.Random(1)
+    patterns = [regex for regex, texts in CASES[:25]]
+    nfas = [NFAfromRegex(pattern).getNFA() for pattern in patterns]
+    for maxstates in (None, 3):
+        regexset = RegexSet(patterns, maxstates=maxstates)
+        for text in generate_texts(rng, count=100):
+            expected = tuple(i for i, nfa in enumerate(nfas) if nfa.test_string(text))
+            assert tuple(regexset.match(text)) == expected
+
+def test_wildcard():
+    nfa = NFAfromRegex("a.c", wildcard=True).getNFA()
+    texts = ["abc", "azc", "ac", "abbc", "aéc"]
+    expected = [True, True, False, False, True]
+    assert [nfa.test_string(text) for text in texts] == expected
+    assert [nfa.to_dfa().test_string(text) for text in texts] == expected
+    assert [nfa.test_string_bitset(text) for text in texts] == expected
+
+def test_escaped_range_character():
+    nfa = NFAfromRegex(r"[a\-z]").getNFA()
+    texts = ["a", "-", "z", "b", "m"]
+    assert [nfa.test_string(text) for text in texts] == [True, True, True, False, False]
+    assert NFAfromRegex(r"[\a-c]").getNFA().test_string("b")
+
+@pytest.mark.parametrize("use_mmap", [True, False])
+def test_save_load_round_trip(tmp_path, use_mmap):
+    for i, (regex, texts) in enumerate(CASES[:30]):
+        nfa = NFAfromRegex(regex).getNFA()
+        path = tmp_path / "automaton{}.bin".format(i)
+        save_automaton(nfa, str(path))
+        loaded = load_automaton(str(path), use_mmap=use_mmap)
+        assert [loaded.test_string(text) for text in texts] == [nfa.test_string(text) for text in texts]
+        assert loaded.match_batch(texts) == [nfa.test_string(text) for text in texts]
+
+def test_load_rejects_other_files(tmp_path):
+    path = tmp_path / "other.bin"
+    path.write_bytes(b"not an automaton at all, just some bytes")
+    with pytest.raises(ValueError):
+        load_automaton(str(path))
+
+def test_match_batch_without_numpy(monkeypatch):
+    regex, texts = CASES[0]
+    nfa = NFAfromRegex(regex).getNFA()
+    monkeypatch.setattr(regex_to_NFA, "numpy", None)
+    assert match_batch(nfa, texts) == [nfa.test_string(text) for text in texts]
+
+def test_equivalent_bounded_dfas():
+    first = NFAfromRegex("(a|b)*a(a|b)(a|b)").getNFA()
+    second = NFAfromRegex("(a|b)*a(a|b)b").getNFA()
+    assert not first.to_dfa(maxstates=2).equivalent(second.to_dfa(maxstates=2))
+    assert first.to_dfa(maxstates=2).equivalent(first.to_dfa())
+    assert first.to_dfa().equivalent(first.to_dfa(maxstates=2))